@@ -0,0 +1,136 @@
+"""Benchmarks import_photos on synthetic iPhoto libraries.
+
+    python -m benchmarks.run --sizes 1000 10000 100000 --work-dir /tmp/bench
+
+Each library is generated once per size and schema and kept in the work dir.
+Every run imports it into a fresh copy of the Shotwell DB in a separate
+process, so the reported peak RSS is that of the import alone, and its wall
+time per stage is read back from the importer's --metrics-json.  Extra
+arguments after -- are passed to the importer, e.g. -- --jobs 8 --fast-db.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from benchmarks.synthetic import create_shotwell_db, generate_library
+from iphoto_export.album_data import read_album_data
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+
+def prepare(work_dir, photos, schema_version):
+    base = os.path.join(work_dir, "library-%d" % photos)
+    library = os.path.join(base, "iPhoto Library")
+    if not os.path.exists(os.path.join(library, "AlbumData.xml")):
+        print("Generating a library of %s photos in %s" % (photos, base))
+        generate_library(base, photos)
+    pristine = os.path.join(base, "photo-%d.db" % schema_version)
+    if not os.path.exists(pristine):
+        create_shotwell_db(pristine, schema_version)
+    return library, pristine
+
+
+def time_plist_parse(library):
+    start = time.monotonic()
+    for _ in read_album_data(os.path.join(library, "AlbumData.xml")):
+        pass
+    return time.monotonic() - start
+
+
+def run_import(work_dir, library, pristine, photos, extra_args):
+    run_dir = os.path.join(work_dir, "run-%d" % photos)
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(run_dir)
+    db = os.path.join(run_dir, "photo.db")
+    shutil.copy(pristine, db)
+    metrics_json = os.path.join(run_dir, "metrics.json")
+    command = [
+        sys.executable,
+        "-m",
+        "iphoto_export.iphoto_import",
+        "--shotwell-db",
+        db,
+        library,
+        os.path.join(run_dir, "photos"),
+        "--metrics-json",
+        metrics_json,
+    ] + extra_args
+    with open(os.path.join(run_dir, "import.log"), "w") as log:
+        start = time.monotonic()
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall = time.monotonic() - start
+    if status != 0:
+        raise RuntimeError("Import failed, see %s" % log.name)
+    # ru_maxrss is in KB on Linux and in bytes on macOS.
+    peak_rss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    with open(metrics_json) as f:
+        metrics = json.load(f)
+    return {
+        "import": wall,
+        "user": rusage.ru_utime,
+        "system": rusage.ru_stime,
+        "peak_rss": peak_rss,
+        "stages": {
+            stage: values["seconds"] for stage, values in metrics["stages"].items()
+        },
+    }
+
+
+def benchmark(work_dir, sizes, schema_version, extra_args):
+    results = []
+    for photos in sizes:
+        library, pristine = prepare(work_dir, photos, schema_version)
+        result = {"photos": photos, "schema": schema_version}
+        result["plist_parse"] = time_plist_parse(library)
+        result.update(run_import(work_dir, library, pristine, photos, extra_args))
+        result["files_per_second"] = photos / result["import"]
+        results.append(result)
+        print(
+            "%8d photos  parse %7.2fs  import %8.2fs  %8.1f files/s  "
+            "cpu %8.2fs  peak RSS %7.1f MB"
+            % (
+                photos,
+                result["plist_parse"],
+                result["import"],
+                result["files_per_second"],
+                result["user"] + result["system"],
+                result["peak_rss"] / 2**20,
+            )
+        )
+        print(
+            "%8s stages %s"
+            % (
+                "",
+                "  ".join("%s %.2fs" % item for item in result["stages"].items()),
+            )
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the iPhoto import on synthetic libraries."
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="library sizes"
+    )
+    parser.add_argument(
+        "--work-dir",
+        default=os.path.join(os.getcwd(), "bench-work"),
+        help="where libraries are generated and imported",
+    )
+    parser.add_argument("--schema", type=int, choices=(16, 20), default=20)
+    parser.add_argument("--json", dest="json_file", help="write the results here")
+    parser.add_argument("import_args", nargs="*", help="passed to the importer")
+    args = parser.parse_args()
+
+    results = benchmark(args.work_dir, args.sizes, args.schema, args.import_args)
+    if args.json_file:
+        with open(args.json_file, "w") as f:
+            json.dump(results, f, indent=2)
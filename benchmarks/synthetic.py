@@ -0,0 +1,317 @@
+"""Generates fake iPhoto libraries and Shotwell DBs for benchmarking.
+
+    python -m benchmarks.synthetic OUT_DIR --photos 1000 --schema 20
+
+creates OUT_DIR/iPhoto Library (AlbumData.xml, Masters/ and Modified/) and
+OUT_DIR/photo.db, an empty Shotwell DB with the given schema version.
+"""
+
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import time
+from xml.sax.saxutils import escape
+
+from PIL import Image  # @UnresolvedImport
+
+# The path the fake library pretends to have been saved at on the Mac.
+ARCHIVE_PATH = "/Users/shaun/Pictures/iPhoto Library"
+LIBRARY_NAME = "iPhoto Library"
+PHOTOS_PER_ROLL = 25
+
+# Extension and PIL format of the masters, picked in this proportion.
+IMAGE_FORMATS = (
+    ("JPG", "JPEG"),
+    ("JPG", "JPEG"),
+    ("JPG", "JPEG"),
+    ("JPG", "JPEG"),
+    ("PNG", "PNG"),
+    ("TIF", "TIFF"),
+)
+
+# The tables the importer touches, as created by Shotwell.  Schema 20 added
+# the comment columns.
+SHOTWELL_SCHEMA = """
+    CREATE TABLE VersionTable (
+        id INTEGER PRIMARY KEY,
+        schema_version INTEGER,
+        app_version TEXT,
+        user_data TEXT NULL
+    );
+    CREATE TABLE PhotoTable (
+        id INTEGER PRIMARY KEY,
+        filename TEXT UNIQUE NOT NULL,
+        width INTEGER,
+        height INTEGER,
+        filesize INTEGER,
+        timestamp INTEGER,
+        exposure_time INTEGER,
+        orientation INTEGER,
+        original_orientation INTEGER,
+        import_id INTEGER,
+        event_id INTEGER,
+        transformations TEXT,
+        md5 TEXT,
+        thumbnail_md5 TEXT,
+        exif_md5 TEXT,
+        time_created INTEGER,
+        flags INTEGER DEFAULT 0,
+        rating INTEGER DEFAULT 0,
+        file_format INTEGER DEFAULT 0,
+        title TEXT,
+        backlinks TEXT,
+        time_reimported INTEGER,
+        editable_id INTEGER DEFAULT -1,
+        metadata_dirty INTEGER DEFAULT 0,
+        developer TEXT,
+        develop_shotwell_id INTEGER DEFAULT -1,
+        develop_camera_id INTEGER DEFAULT -1,
+        develop_embedded_id INTEGER DEFAULT -1
+        %(comment)s
+    );
+    CREATE INDEX PhotoEventIDIndex ON PhotoTable (event_id);
+    CREATE TABLE BackingPhotoTable (
+        id INTEGER PRIMARY KEY,
+        filepath TEXT UNIQUE NOT NULL,
+        timestamp INTEGER,
+        filesize INTEGER,
+        width INTEGER,
+        height INTEGER,
+        original_orientation INTEGER,
+        file_format INTEGER,
+        time_created INTEGER
+    );
+    CREATE TABLE EventTable (
+        id INTEGER PRIMARY KEY,
+        name TEXT,
+        primary_photo_id INTEGER,
+        time_created INTEGER,
+        primary_source_id TEXT
+        %(comment)s
+    );
+    CREATE TABLE VideoTable (
+        id INTEGER PRIMARY KEY,
+        filename TEXT UNIQUE NOT NULL,
+        width INTEGER,
+        height INTEGER,
+        clip_duration REAL,
+        is_interpretable INTEGER,
+        filesize INTEGER,
+        timestamp INTEGER,
+        exposure_time INTEGER,
+        import_id INTEGER,
+        event_id INTEGER,
+        md5 TEXT NOT NULL,
+        time_created INTEGER,
+        rating INTEGER DEFAULT 0,
+        title TEXT,
+        backlinks TEXT,
+        time_reimported INTEGER,
+        flags INTEGER DEFAULT 0
+        %(comment)s
+    );
+    CREATE INDEX VideoEventIDIndex ON VideoTable (event_id);
+"""
+
+
+def create_shotwell_db(filename, schema_version=20):
+    if os.path.exists(filename):
+        os.unlink(filename)
+    db = sqlite3.connect(filename)
+    comment = ", comment TEXT" if schema_version >= 20 else ""
+    db.executescript(SHOTWELL_SCHEMA % {"comment": comment})
+    db.execute(
+        "INSERT INTO VersionTable (schema_version, app_version) VALUES (?, ?)",
+        (schema_version, "0.%s.0" % schema_version),
+    )
+    db.commit()
+    db.close()
+
+
+def timer_interval(dt):
+    # iPhoto's dates are seconds since 2001-01-01.
+    return (dt - datetime.datetime(2001, 1, 1)).total_seconds()
+
+
+def write_image(path, fmt, seed, size, dt, orientation):
+    rng = random.Random(repr(seed))
+    color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    img = Image.new("RGB", size, color)
+    # A few random pixels keep every file unique.
+    for _ in range(8):
+        img.putpixel((rng.randrange(size[0]), rng.randrange(size[1])), (0, 0, 0))
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    exif[0x0132] = dt.strftime("%Y:%m:%d %H:%M:%S")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    img.save(path, fmt, exif=exif)
+
+
+class PlistWriter:
+    # Writes the XML plist by hand, so even huge libraries never have to be
+    # held in memory as a whole.
+
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, text):
+        self.f.write(text.encode("utf-8"))
+
+    def value(self, value, indent):
+        pad = "\t" * indent
+        if isinstance(value, bool):
+            self.write("%s<%s/>\n" % (pad, "true" if value else "false"))
+        elif isinstance(value, int):
+            self.write("%s<integer>%d</integer>\n" % (pad, value))
+        elif isinstance(value, float):
+            self.write("%s<real>%r</real>\n" % (pad, value))
+        elif isinstance(value, str):
+            self.write("%s<string>%s</string>\n" % (pad, escape(value)))
+        elif isinstance(value, dict):
+            self.write("%s<dict>\n" % pad)
+            for key, item in value.items():
+                self.key(key, indent + 1)
+                self.value(item, indent + 1)
+            self.write("%s</dict>\n" % pad)
+        else:
+            self.write("%s<array>\n" % pad)
+            for item in value:
+                self.value(item, indent + 1)
+            self.write("%s</array>\n" % pad)
+
+    def key(self, key, indent):
+        self.write("%s<key>%s</key>\n" % ("\t" * indent, escape(key)))
+
+
+def generate_library(
+    out_dir,
+    photos,
+    modified_fraction=0.2,
+    missing_fraction=0.01,
+    seed=0,
+    image_size=(160, 120),
+):
+    """Creates a fake iPhoto library with the given number of photos.
+
+    Returns the path of the library.  Masters are spread over
+    Masters/YYYY/MM/DD/Roll directories like iPhoto does, a
+    modified_fraction of them has a version in Modified/ and a
+    missing_fraction is listed in AlbumData.xml but missing on disk.
+    """
+    rng = random.Random(seed)
+    library = os.path.join(out_dir, LIBRARY_NAME)
+    os.makedirs(library, exist_ok=True)
+    start = datetime.datetime(2005, 1, 1)
+
+    rolls = []
+    entries = []
+    for i in range(photos):
+        roll_id = i // PHOTOS_PER_ROLL
+        dt = start + datetime.timedelta(hours=roll_id * 24, minutes=i % PHOTOS_PER_ROLL)
+        if roll_id == len(rolls):
+            rolls.append(
+                {
+                    "RollID": roll_id,
+                    "ProjectUuid": "roll%08d" % roll_id,
+                    "RollName": "Roll %d" % roll_id,
+                    "RollDateAsTimerInterval": timer_interval(dt),
+                    "KeyPhotoKey": str(i),
+                    "PhotoCount": 0,
+                    "KeyList": [],
+                }
+            )
+        roll = rolls[roll_id]
+        roll["KeyList"].append(str(i))
+        roll["PhotoCount"] += 1
+
+        ext, fmt = IMAGE_FORMATS[i % len(IMAGE_FORMATS)]
+        rel_dir = os.path.join(dt.strftime("%Y/%m/%d"), "Roll %d" % roll_id)
+        master = os.path.join("Masters", rel_dir, "IMG_%06d.%s" % (i, ext))
+        orientation = rng.choice((1, 1, 1, 6, 8, 3))
+        entry = {
+            "MediaType": "Image",
+            "Caption": "IMG_%06d" % i,
+            "Comment": "",
+            "GUID": "guid%08d" % i,
+            "Roll": roll_id,
+            "Rating": rng.randrange(6),
+            "ImagePath": os.path.join(ARCHIVE_PATH, master),
+            "ThumbPath": os.path.join(ARCHIVE_PATH, "Thumbnails", master),
+            "DateAsTimerInterval": timer_interval(dt),
+            "ModDateAsTimerInterval": timer_interval(dt),
+            "DateAddedAsTimerInterval": timer_interval(dt),
+        }
+        if rng.random() < missing_fraction:
+            entries.append((str(i), entry))
+            continue
+        write_image(
+            os.path.join(library, master), fmt, (seed, i), image_size, dt, orientation
+        )
+        if rng.random() < modified_fraction:
+            modified = os.path.join("Modified", rel_dir, "IMG_%06d.%s" % (i, ext))
+            write_image(
+                os.path.join(library, modified),
+                fmt,
+                (seed, i, "modified"),
+                image_size[::-1],
+                dt,
+                1,
+            )
+            entry["OriginalPath"] = entry["ImagePath"]
+            entry["ImagePath"] = os.path.join(ARCHIVE_PATH, modified)
+        entries.append((str(i), entry))
+
+    with open(os.path.join(library, "AlbumData.xml"), "wb") as f:
+        plist = PlistWriter(f)
+        plist.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" '
+            '"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+            '<plist version="1.0">\n<dict>\n'
+        )
+        plist.key("Application Version", 1)
+        plist.value("9.6.1 (9.6.1)", 1)
+        plist.key("Archive Path", 1)
+        plist.value(ARCHIVE_PATH, 1)
+        plist.key("List of Albums", 1)
+        plist.value([{"AlbumId": 999000, "AlbumName": "Photos", "KeyList": []}], 1)
+        plist.key("List of Rolls", 1)
+        plist.value(rolls, 1)
+        plist.key("Major Version", 1)
+        plist.value(2, 1)
+        plist.key("Master Image List", 1)
+        plist.write("\t<dict>\n")
+        for key, entry in entries:
+            plist.key(key, 2)
+            plist.value(entry, 2)
+        plist.write("\t</dict>\n")
+        plist.key("Minor Version", 1)
+        plist.value(0, 1)
+        plist.write("</dict>\n</plist>\n")
+    return library
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate a fake iPhoto library and Shotwell DB."
+    )
+    parser.add_argument("out_dir", metavar="OUT_DIR", help="directory to create")
+    parser.add_argument("--photos", type=int, default=1000)
+    parser.add_argument("--modified-fraction", type=float, default=0.2)
+    parser.add_argument("--missing-fraction", type=float, default=0.01)
+    parser.add_argument("--schema", type=int, choices=(16, 20), default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    library = generate_library(
+        args.out_dir,
+        args.photos,
+        args.modified_fraction,
+        args.missing_fraction,
+        args.seed,
+    )
+    create_shotwell_db(os.path.join(args.out_dir, "photo.db"), args.schema)
+    print("Generated %s in %.1fs" % (library, time.monotonic() - start))
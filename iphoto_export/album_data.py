@@ -0,0 +1,289 @@
+import array
+import base64
+import bisect
+import datetime
+import logging
+import os.path
+import time
+from xml.etree.ElementTree import iterparse
+
+from iphoto_export.sync import CHANGED
+
+_log = logging.getLogger("iphotoimport")
+
+# Top level containers of AlbumData.xml whose entries are yielded one by one
+# instead of being loaded as a whole.
+MASTER_IMAGE_LIST = "Master Image List"
+LIST_OF_ROLLS = "List of Rolls"
+
+# Kinds of items yielded by read_album_data().
+PROPERTY = "property"
+PHOTO = "photo"
+ROLL = "roll"
+
+# The property the paths of the Master Image List begin with, see
+# ArchivePaths.
+ARCHIVE_PATH = "Archive Path"
+
+# Reasons for leaving out an entry of the Master Image List, see entry_skip().
+SKIP_NOT_SELECTED = "not selected"
+SKIP_UNCHANGED = "unchanged"
+SKIP_IMPORTED = "already imported"
+
+# Element depths inside the plist: <plist> is 1, the top level <dict> is 2,
+# its keys and values are 3 and the entries of a top level container are 4.
+_TOP_LEVEL = 3
+_ENTRY = 4
+
+
+def read_album_data(source):
+    """Incrementally parse an iPhoto AlbumData.xml file.
+
+    Yields (kind, key, value) tuples in file order:
+
+    * (PROPERTY, name, value) for each scalar top level entry, e.g.
+      "Archive Path" or "Major Version",
+    * (ROLL, None, roll) for each entry of the List of Rolls,
+    * (PHOTO, key, photo) for each entry of the Master Image List.
+
+    Other top level containers (albums, faces, keywords...) are skipped.
+    Parsed elements are discarded as soon as they have been yielded so memory
+    use does not grow with the size of the library.
+    """
+    depth = 0
+    top_key = None
+    entry_key = None
+    root = None
+    container = None
+    for event, elem in iterparse(source, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth == _TOP_LEVEL - 1:
+                root = elem
+            elif depth == _TOP_LEVEL and elem.tag != "key":
+                container = elem
+            continue
+
+        if depth == _ENTRY:
+            if top_key == MASTER_IMAGE_LIST:
+                if elem.tag == "key":
+                    entry_key = elem.text
+                else:
+                    yield PHOTO, entry_key, _value(elem)
+            elif top_key == LIST_OF_ROLLS:
+                yield ROLL, None, _value(elem)
+            container.clear()
+        elif depth == _TOP_LEVEL:
+            if elem.tag == "key":
+                top_key = elem.text
+            else:
+                if elem.tag not in ("dict", "array"):
+                    yield PROPERTY, top_key, _value(elem)
+                root.clear()
+                container = None
+        depth -= 1
+
+
+class AlbumDataError(ValueError):
+    pass
+
+
+def located_photos(items):
+    """Hold back the photos of read_album_data() until they can be located.
+
+    The paths of the Master Image List begin with the "Archive Path", which
+    may come after it in the file.  The photos listed before it are yielded
+    right after it, the other items are passed through.  Raises
+    AlbumDataError if the file has no Archive Path.
+    """
+    pending = []
+    located = False
+    for item in items:
+        kind, key, _ = item
+        if kind == PHOTO and not located:
+            pending.append(item)
+            continue
+        yield item
+        if kind == PROPERTY and key == ARCHIVE_PATH:
+            located = True
+            yield from pending
+            pending = []
+    if pending:
+        raise AlbumDataError("iPhoto library file doesn't contain an Archive Path")
+
+
+def _value(elem):
+    tag = elem.tag
+    if tag == "dict":
+        children = list(elem)
+        return {
+            children[i].text or "": _value(children[i + 1])
+            for i in range(0, len(children), 2)
+        }
+    if tag == "array":
+        return [_value(child) for child in elem]
+    if tag == "string":
+        return elem.text or ""
+    if tag == "integer":
+        return int(elem.text)
+    if tag == "real":
+        return float(elem.text)
+    if tag == "true":
+        return True
+    if tag == "false":
+        return False
+    if tag == "date":
+        return datetime.datetime.strptime(elem.text, "%Y-%m-%dT%H:%M:%SZ")
+    if tag == "data":
+        return base64.b64decode(elem.text or "")
+    raise ValueError("Unsupported plist element <%s>" % tag)
+
+
+class KeySet:
+    """Read-only set of the photo keys of a roll or an album.
+
+    Keys are decimal strings; a roll's KeyList is kept as a sorted array of
+    8 byte integers instead of a set of strings, which would take about ten
+    times as much memory for the whole library.
+    """
+
+    __slots__ = ("keys",)
+
+    def __init__(self, keys):
+        self.keys = array.array("q", sorted(int(key) for key in keys))
+
+    def __contains__(self, key):
+        try:
+            key = int(key)
+        except ValueError:
+            return False
+        i = bisect.bisect_left(self.keys, key)
+        return i < len(self.keys) and self.keys[i] == key
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def parse_date(timer_interval):
+    # iPhoto stores dates as seconds since 2001-01-01.
+    dt = datetime.datetime(2001, 1, 1) + datetime.timedelta(seconds=timer_interval)
+    return time.mktime(dt.timetuple())
+
+
+class Selection:
+    """The part of a library an import takes.
+
+    Photos are checked while the library file is streamed, before any of
+    their files is touched, so the photos left out cost nothing but parsing.
+    rolls is a set of RollIDs, since and until are timestamps the photo's
+    date must be at or after and before, and the photo's master must be
+    below one of path_prefixes, paths relative to the library.  Filters
+    that are None or empty select everything.
+    """
+
+    def __init__(self, rolls=None, since=None, until=None, path_prefixes=()):
+        self.rolls = frozenset(rolls) if rolls else None
+        self.since = since
+        self.until = until
+        self.path_prefixes = tuple(
+            os.path.normpath(prefix).strip(os.path.sep) for prefix in path_prefixes
+        )
+
+    def __bool__(self):
+        return bool(
+            self.rolls
+            or self.since is not None
+            or self.until is not None
+            or self.path_prefixes
+        )
+
+    def __repr__(self):
+        return "Selection(rolls=%r, since=%r, until=%r, path_prefixes=%r)" % (
+            self.rolls and sorted(self.rolls),
+            self.since,
+            self.until,
+            self.path_prefixes,
+        )
+
+    def roll(self, roll):
+        return self.rolls is None or roll["RollID"] in self.rolls
+
+    def photo(self, i_photo, master_path):
+        # master_path is the path of the photo's original relative to the
+        # library.
+        if self.rolls is not None and i_photo["Roll"] not in self.rolls:
+            return False
+        if self.since is not None or self.until is not None:
+            date = parse_date(i_photo["DateAsTimerInterval"])
+            if self.since is not None and date < self.since:
+                return False
+            if self.until is not None and date >= self.until:
+                return False
+        if self.path_prefixes:
+            return any(
+                master_path == prefix or master_path.startswith(prefix + os.path.sep)
+                for prefix in self.path_prefixes
+            )
+        return True
+
+
+class ArchivePaths:
+    """Moves the paths of a library file below other directories.
+
+    The paths in AlbumData.xml begin with archive_path, where the library
+    was when iPhoto wrote it.  The files are read below iphoto_dir and
+    written below photos_dir.
+    """
+
+    def __init__(self, archive_path, iphoto_dir, photos_dir):
+        self.archive_path = archive_path
+        self.iphoto_dir = iphoto_dir
+        self.photos_dir = photos_dir
+
+    def fix_prefix(self, path, new_prefix):
+        if path:
+            if path[: len(self.archive_path)] != self.archive_path:
+                raise AssertionError(
+                    "Path %s didn't begin with %s" % (path, self.archive_path)
+                )
+            path = path[len(self.archive_path) :]
+            path = os.path.join(new_prefix, path.strip(os.path.sep))
+        return path
+
+    def source(self, path):
+        return self.fix_prefix(path, self.iphoto_dir)
+
+    def destination(self, path):
+        return self.fix_prefix(path, self.photos_dir)
+
+    def relative(self, path):
+        return self.fix_prefix(path, "")
+
+
+def entry_skip(
+    key, i_photo, paths, selection, imported_filenames, sync_state=None, changed=None
+):
+    """Why an entry of the Master Image List is left out of an import.
+
+    Returns None for the entries to import, otherwise SKIP_NOT_SELECTED,
+    SKIP_UNCHANGED or SKIP_IMPORTED.  Entries are checked while the library
+    file is streamed, before any of their files is touched.  With a
+    sync_state the entries unchanged since the last sync are left out and
+    the ones edited or reverted since are taken again, their keys are added
+    to the changed set.  imported_filenames are the filenames of the photos
+    and videos in the Shotwell DB.
+    """
+    master = i_photo.get("OriginalPath") or i_photo.get("ImagePath")
+    if not selection.photo(i_photo, paths.relative(master)):
+        return SKIP_NOT_SELECTED
+    if sync_state is not None:
+        change = sync_state.change(key, i_photo)
+        if change is None:
+            return SKIP_UNCHANGED
+        if change == CHANGED:
+            changed.add(key)
+            return None
+    for path in (i_photo.get("OriginalPath"), i_photo.get("ImagePath")):
+        if path and paths.destination(path) in imported_filenames:
+            return SKIP_IMPORTED
+    return None
@@ -0,0 +1,180 @@
+import logging
+import sqlite3
+import time
+from urllib.request import pathname2url
+
+_log = logging.getLogger("iphotoimport")
+
+# Number of files remembered by default.  A row is ~200 bytes, so this keeps
+# the cache file well below 100MB.
+DEFAULT_MAX_ENTRIES = 500000
+
+# Pending writes are committed every this many puts so the probes of an
+# import that dies half way survive for the next run.
+COMMIT_INTERVAL = 1000
+
+# Values cached for each file, see PhotoProber.probe_file().
+PROBE_FIELDS = (
+    "md5",
+    "width",
+    "height",
+    "orientation",
+    "exposure_time",
+    "mime",
+    "clip_duration",
+)
+
+
+class ProbeCache:
+    """Sidecar SQLite file remembering the probe results of each file.
+
+    Entries are keyed by path and only returned while the file's size,
+    mtime and inode are unchanged, so a modified or replaced file is
+    re-probed.  The least recently used entries are evicted once the cache
+    holds more than max_entries files.
+
+    A readonly cache, used by the probe workers, can't update an entry or
+    drop a stale one.  It records the paths it found instead, see
+    take_used(), so the writable cache of the importer can touch() and
+    forget() them.
+    """
+
+    def __init__(self, filename, max_entries=DEFAULT_MAX_ENTRIES, readonly=False):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.readonly = readonly
+        self.now = int(time.time())
+        self.pending = 0
+        self.hits = []
+        self.stale = []
+        if readonly:
+            self.db = connect_readonly(filename)
+        else:
+            self.db = sqlite3.connect(filename)
+            self.init()
+
+    def get(self, path, st):
+        cursor = self.db.execute(
+            "SELECT size, mtime_ns, inode, %s FROM ProbeTable WHERE path = ?"
+            % ", ".join(PROBE_FIELDS),
+            (path,),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        size, mtime_ns, inode = row[:3]
+        if (size, mtime_ns, inode) != (st.st_size, st.st_mtime_ns, st.st_ino):
+            if self.readonly:
+                self.stale.append(path)
+            else:
+                self.forget([path])
+            return None
+        if self.readonly:
+            self.hits.append(path)
+        else:
+            self.touch([path])
+        return dict(zip(PROBE_FIELDS, row[3:]))
+
+    def get_by_inode(self, st):
+        # Returns the probe of a file with the same device, inode, size and
+        # mtime as st, i.e. of another path hard linked to the same file,
+        # e.g. the source of an imported file.
+        cursor = self.db.execute(
+            "SELECT %s FROM ProbeTable "
+            "WHERE inode = ? AND device = ? AND size = ? AND mtime_ns = ? LIMIT 1"
+            % ", ".join(PROBE_FIELDS),
+            (st.st_ino, st.st_dev, st.st_size, st.st_mtime_ns),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip(PROBE_FIELDS, row))
+
+    def take_used(self):
+        # Returns and clears the (hits, stale) paths a readonly cache found
+        # since the last call.
+        used = self.hits, self.stale
+        self.hits = []
+        self.stale = []
+        return used
+
+    def touch(self, paths):
+        # Marks the entries of paths as used now, so they're evicted last.
+        self.db.executemany(
+            "UPDATE ProbeTable SET last_used = ? WHERE path = ?",
+            [(self.now, path) for path in paths],
+        )
+        self._written(len(paths))
+
+    def forget(self, paths):
+        # Drops the entries of files that changed since they were probed.
+        self.db.executemany(
+            "DELETE FROM ProbeTable WHERE path = ?", [(path,) for path in paths]
+        )
+        self._written(len(paths))
+
+    def put(self, path, st, probe):
+        self.db.execute(
+            "INSERT OR REPLACE INTO ProbeTable "
+            "(path, size, mtime_ns, inode, device, last_used, %s) "
+            "VALUES (?, ?, ?, ?, ?, ?, %s)"
+            % (", ".join(PROBE_FIELDS), ", ".join("?" * len(PROBE_FIELDS))),
+            (path, st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev, self.now)
+            + tuple(probe.get(field) for field in PROBE_FIELDS),
+        )
+        self._written()
+
+    def close(self):
+        if not self.readonly:
+            self.evict()
+            self.db.commit()
+        self.db.close()
+
+    def evict(self):
+        cursor = self.db.execute(
+            "DELETE FROM ProbeTable WHERE path IN ("
+            "SELECT path FROM ProbeTable ORDER BY last_used DESC "
+            "LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        if cursor.rowcount > 0:
+            _log.debug("Evicted %s entries from the probe cache", cursor.rowcount)
+
+    def _written(self, n=1):
+        self.pending += n
+        if self.pending >= COMMIT_INTERVAL:
+            self.db.commit()
+            self.pending = 0
+
+    def init(self):
+        # WAL lets the probe workers read while the importer writes.
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS ProbeTable ("
+            "path TEXT PRIMARY KEY, "
+            "size INTEGER, "
+            "mtime_ns INTEGER, "
+            "inode INTEGER, "
+            "device INTEGER, "
+            "last_used INTEGER, "
+            "md5 TEXT, "
+            "width INTEGER, "
+            "height INTEGER, "
+            "orientation INTEGER, "
+            "exposure_time INTEGER, "
+            "mime TEXT, "
+            "clip_duration REAL"
+            ")"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS ProbeLastUsedIndex ON ProbeTable (last_used)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS ProbeInodeIndex ON ProbeTable (inode)"
+        )
+        self.db.commit()
+
+
+def connect_readonly(filename):
+    # The path is quoted, a # or ? in it would end the URI's path.
+    return sqlite3.connect("file:%s?mode=ro" % pathname2url(filename), uri=True)
@@ -1,3 +1,107 @@
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+_log = logging.getLogger("iphotoimport")
+
+# PRAGMAs trading durability for speed while importing, see import_pragmas().
+# A crash during the import may corrupt the DB, restore it from the backup
+# taken at the start of the import in that case.
+FAST_IMPORT_PRAGMAS = (
+    ("synchronous", "OFF"),
+    ("journal_mode", "MEMORY"),
+    ("cache_size", -262144),  # 256MB
+)
+
+
+@contextlib.contextmanager
+def import_pragmas(db, pragmas):
+    # Applies pragmas for the duration of the block and restores the previous
+    # values afterwards.  journal_mode can't change inside a transaction, so
+    # the block starts with a commit and ends with a commit (or a rollback if
+    # it raised).
+    db.commit()
+    saved = []
+    for name, value in pragmas:
+        saved.append((name, db.execute("PRAGMA %s" % name).fetchone()[0]))
+        _log.debug("Setting PRAGMA %s = %s", name, value)
+        db.execute("PRAGMA %s = %s" % (name, value))
+    try:
+        yield
+    except BaseException:
+        db.rollback()
+        raise
+    else:
+        db.commit()
+    finally:
+        for name, value in reversed(saved):
+            db.execute("PRAGMA %s = %s" % (name, value))
+
+
+# Pages copied per step of a backup.  The DB is only locked during a step.
+BACKUP_PAGES = 1024
+
+
+def backup_filename(shotwell_db, import_id):
+    return "%s.iphotobak_%s" % (shotwell_db, import_id)
+
+
+class Backup:
+    """Copy of a DB taken with sqlite's online backup API on a thread.
+
+    The DB is copied BACKUP_PAGES pages at a time from a connection of its
+    own.  A write through any other connection restarts the copy, so writers
+    must wait() for it to finish first.
+    """
+
+    def __init__(self, filename, backup_filename, pages=BACKUP_PAGES):
+        self.filename = filename
+        self.backup_filename = backup_filename
+        self.pages = pages
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="backup", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        try:
+            copy_database(self.filename, self.backup_filename, self.pages)
+        except BaseException as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread.is_alive():
+            _log.debug("Waiting for the backup to %s", self.backup_filename)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def copy_database(filename, copy_filename, pages=BACKUP_PAGES):
+    # Copies the DB in filename to copy_filename, replacing its content.
+    tmp = copy_filename + ".part"
+    src = sqlite3.connect(filename)
+    try:
+        dst = sqlite3.connect(tmp)
+        try:
+            src.backup(dst, pages=pages)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+    os.replace(tmp, copy_filename)
+
+
+def _next_id(db, table):
+    cursor = db.execute("SELECT max(id) FROM %s" % table)
+    return (cursor.fetchone()[0] or 0) + 1
+
+
 # The BackingPhotoTable
 #                  id = 1
 #            filepath = /home/shaun/Pictures/Photos/2008/03/24/DSCN2416 (Modified (2))_modified.JPG
@@ -11,14 +115,9 @@
 
 
 class BackingPhotoTable:
-    def __init__(self, db):
-        self.db = db
-        self.init()
-
-    def insert(self, photo):
-        cursor = self.db.execute(
-            """
-                    INSERT INTO BackingPhotoTable (filepath,
+    INSERT_SQL = """
+                    INSERT INTO BackingPhotoTable (id,
+                                                   filepath,
                                                    timestamp,
                                                    filesize,
                                                    width,
@@ -26,7 +125,8 @@ class BackingPhotoTable:
                                                    original_orientation,
                                                    file_format,
                                                    time_created)
-                    VALUES (:new_mod_path,
+                    VALUES (:editable_id,
+                            :new_mod_path,
                             :mod_timestamp,
                             :mod_file_size,
                             :mod_width,
@@ -34,11 +134,31 @@ class BackingPhotoTable:
                             :mod_original_orientation,
                             :file_format,
                             :time_created)
-                """,
-            photo,
-        )
+                """
+
+    def __init__(self, db):
+        self.db = db
+        self.init()
+
+    def insert(self, photo):
+        cursor = self.db.execute(self.INSERT_SQL, dict(photo, editable_id=None))
         return cursor.lastrowid
 
+    def insert_many(self, photos):
+        # The ids are allocated up front and stored as each photo's
+        # editable_id, so they are known without reading back every row.
+        next_id = _next_id(self.db, "BackingPhotoTable")
+        for i, photo in enumerate(photos):
+            photo["editable_id"] = next_id + i
+        # Photo records are turned into dicts one row at a time, sqlite3
+        # only takes named parameters from dicts.
+        self.db.executemany(self.INSERT_SQL, map(dict, photos))
+
+    def filepaths(self):
+        # Map from filepath to id of all backing photos already in the DB.
+        cursor = self.db.execute("SELECT filepath, id FROM BackingPhotoTable")
+        return dict(cursor)
+
     def init(self):
         cursor = self.db.execute(
             "SELECT count(*) FROM sqlite_master WHERE type='table' AND name='BackingPhotoTable'"
@@ -56,3 +176,490 @@ class BackingPhotoTable:
                 "time_created INTEGER "
                 ")"
             )
+
+
+class PhotoTable:
+    INSERT_SQL = """
+                    INSERT INTO PhotoTable (id,
+                                            filename,
+                                            width,
+                                            height,
+                                            filesize,
+                                            timestamp,
+                                            exposure_time,
+                                            orientation,
+                                            original_orientation,
+                                            import_id,
+                                            event_id,
+                                            md5,
+                                            time_created,
+                                            flags,
+                                            rating,
+                                            file_format,
+                                            title,
+                                            editable_id,
+                                            metadata_dirty,
+                                            developer,
+                                            develop_shotwell_id,
+                                            develop_camera_id,
+                                            develop_embedded_id%(comment_column)s)
+                    VALUES (:id,
+                            :new_orig_path,
+                            :width,
+                            :height,
+                            :orig_file_size,
+                            :orig_timestamp,
+                            :orig_exposure_time,
+                            :orientation,
+                            :orig_original_orientation,
+                            :import_id,
+                            :event_id,
+                            :orig_md5,
+                            :time_created,
+                            0,
+                            :rating,
+                            :file_format,
+                            :caption,
+                            :editable_id,
+                            1,
+                            'SHOTWELL',
+                            -1,
+                            -1,
+                            -1%(comment_value)s);
+                """
+
+    def __init__(self, db, schema_version=20):
+        self.db = db
+        # The comment column was added in schema version 20.
+        if schema_version >= 20:
+            columns = {"comment_column": ", comment", "comment_value": ", :comment"}
+        else:
+            columns = {"comment_column": "", "comment_value": ""}
+        self.insert_sql = self.INSERT_SQL % columns
+
+    def insert(self, photo):
+        cursor = self.db.execute(self.insert_sql, dict(photo, id=None))
+        return cursor.lastrowid
+
+    def insert_many(self, photos):
+        # Sets the id of each photo, see BackingPhotoTable.insert_many().
+        next_id = _next_id(self.db, "PhotoTable")
+        for i, photo in enumerate(photos):
+            photo["id"] = next_id + i
+        self.db.executemany(self.insert_sql, map(dict, photos))
+
+    def filenames(self):
+        cursor = self.db.execute("SELECT filename FROM PhotoTable")
+        return {row[0] for row in cursor}
+
+    def set_editable_ids(self, photos):
+        # Points already imported photos at their current modified version,
+        # or at none if editable_id is -1.  Returns the (id, editable_id)
+        # of the photos before the update, for ImportRowTable.add_updated().
+        previous = []
+        for photo in photos:
+            cursor = self.db.execute(
+                "SELECT id, editable_id FROM PhotoTable WHERE filename = ?",
+                (photo["new_orig_path"],),
+            )
+            previous.extend(cursor)
+        self.db.executemany(
+            "UPDATE PhotoTable SET editable_id = ? WHERE filename = ?",
+            ((photo["editable_id"], photo["new_orig_path"]) for photo in photos),
+        )
+        return previous
+
+    def thumbnail_sources(self, import_id):
+        # (id, path, orientation) of the photos of an import, and of the
+        # photos whose modified version it updated, the path being the
+        # modified version if there is one, as Shotwell shows that.
+        return self.db.execute(
+            "SELECT p.id, coalesce(b.filepath, p.filename), p.orientation "
+            "FROM PhotoTable p LEFT JOIN BackingPhotoTable b ON b.id = p.editable_id "
+            "WHERE p.import_id = :import_id OR p.id IN ("
+            "SELECT row_id FROM IPhotoImportRowTable "
+            "WHERE import_id = :import_id AND table_name = 'PhotoTable') "
+            "ORDER BY p.id",
+            {"import_id": import_id},
+        )
+
+
+# The VideoTable
+#                  id = 12
+#            filename = /home/shaun/Pictures/Photos/2008/03/24/MVI_2417.MOV
+#               width = 640
+#              height = 480
+#       clip_duration = 12.3
+#    is_interpretable = 0
+#            filesize = 19377211
+#           timestamp = 1348718403
+#       exposure_time = 1206392706
+#           import_id = 1348941635
+#            event_id = 3
+#                 md5 = 8a8e8b4a1b5a2b2c0c1c1d8b3f8c6e2a
+#        time_created = 1348941635
+#              rating = 0
+#               title =
+#           backlinks =
+#     time_reimported =
+#               flags = 0
+
+
+class VideoTable:
+    # is_interpretable is left 0, Shotwell checks those movies in the
+    # background when it starts and makes their thumbnails then.
+    INSERT_SQL = """
+                    INSERT INTO VideoTable (id,
+                                            filename,
+                                            width,
+                                            height,
+                                            clip_duration,
+                                            is_interpretable,
+                                            filesize,
+                                            timestamp,
+                                            exposure_time,
+                                            import_id,
+                                            event_id,
+                                            md5,
+                                            time_created,
+                                            rating,
+                                            title,
+                                            flags%(comment_column)s)
+                    VALUES (:id,
+                            :new_orig_path,
+                            :width,
+                            :height,
+                            :clip_duration,
+                            0,
+                            :orig_file_size,
+                            :orig_timestamp,
+                            :orig_exposure_time,
+                            :import_id,
+                            :event_id,
+                            :orig_md5,
+                            :time_created,
+                            :rating,
+                            :caption,
+                            0%(comment_value)s);
+                """
+
+    def __init__(self, db, schema_version=20):
+        self.db = db
+        # See PhotoTable.
+        if schema_version >= 20:
+            columns = {"comment_column": ", comment", "comment_value": ", :comment"}
+        else:
+            columns = {"comment_column": "", "comment_value": ""}
+        self.insert_sql = self.INSERT_SQL % columns
+        self.comment = schema_version >= 20
+        self.init()
+
+    def insert_many(self, videos):
+        # Sets the id of each video, see BackingPhotoTable.insert_many().
+        next_id = _next_id(self.db, "VideoTable")
+        for i, video in enumerate(videos):
+            video["id"] = next_id + i
+        self.db.executemany(self.insert_sql, map(dict, videos))
+
+    def filenames(self):
+        cursor = self.db.execute("SELECT filename FROM VideoTable")
+        return {row[0] for row in cursor}
+
+    def init(self):
+        cursor = self.db.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type='table' AND name='VideoTable'"
+        )
+        if cursor.fetchone()[0] == 0:
+            self.db.execute(
+                "CREATE TABLE VideoTable ("
+                "id INTEGER PRIMARY KEY, "
+                "filename TEXT UNIQUE NOT NULL, "
+                "width INTEGER, "
+                "height INTEGER, "
+                "clip_duration REAL, "
+                "is_interpretable INTEGER, "
+                "filesize INTEGER, "
+                "timestamp INTEGER, "
+                "exposure_time INTEGER, "
+                "import_id INTEGER, "
+                "event_id INTEGER, "
+                "md5 TEXT NOT NULL, "
+                "time_created INTEGER, "
+                "rating INTEGER DEFAULT 0, "
+                "title TEXT, "
+                "backlinks TEXT, "
+                "time_reimported INTEGER, "
+                "flags INTEGER DEFAULT 0%s"
+                ")" % (", comment TEXT" if self.comment else "")
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS VideoEventIDIndex ON VideoTable (event_id)"
+            )
+
+
+class EventTable:
+    INSERT_SQL = """
+                    INSERT INTO EventTable (id, time_created, name)
+                    VALUES (:row_id, :date, :name)
+                """
+
+    def __init__(self, db):
+        self.db = db
+
+    def insert(self, event):
+        cursor = self.db.execute(self.INSERT_SQL, dict(event, row_id=None))
+        return cursor.lastrowid
+
+    def insert_many(self, events):
+        # Sets the row_id of each event, see BackingPhotoTable.insert_many().
+        next_id = _next_id(self.db, "EventTable")
+        for i, event in enumerate(events):
+            event["row_id"] = next_id + i
+        self.db.executemany(self.INSERT_SQL, events)
+
+    def ids(self):
+        # Map from (name, time_created) to id of all events already in the DB.
+        cursor = self.db.execute("SELECT name, time_created, id FROM EventTable")
+        return {(name, time_created): id for name, time_created, id in cursor}
+
+
+# The ImportTable is not part of Shotwell's schema.  It records the imports
+# done by this script so an interrupted import can be resumed with the same
+# import_id.
+#                  id = 1348941635 (the import_id of the photos)
+#          iphoto_dir = /home/shaun/iPhoto Library
+#        time_started = 1348941635
+#     time_checkpoint = 1348941702
+#              photos = 2000
+#            finished = 0
+
+
+class ImportTable:
+    def __init__(self, db):
+        self.db = db
+        self.init()
+
+    def unfinished(self, iphoto_dir):
+        cursor = self.db.execute(
+            "SELECT id FROM IPhotoImportTable WHERE iphoto_dir = ? AND finished = 0 "
+            "ORDER BY id DESC LIMIT 1",
+            (iphoto_dir,),
+        )
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def start(self, import_id, iphoto_dir):
+        # import_ids are timestamps, two imports started within the same
+        # second get consecutive ones.
+        cursor = self.db.execute("SELECT max(id) FROM IPhotoImportTable")
+        last_id = cursor.fetchone()[0]
+        if last_id is not None and last_id >= import_id:
+            import_id = last_id + 1
+        self.db.execute(
+            "INSERT INTO IPhotoImportTable "
+            "(id, iphoto_dir, time_started, time_checkpoint, photos, finished) "
+            "VALUES (?, ?, ?, ?, 0, 0)",
+            (import_id, iphoto_dir, int(time.time()), int(time.time())),
+        )
+        return import_id
+
+    def checkpoint(self, import_id, photos):
+        self.db.execute(
+            "UPDATE IPhotoImportTable SET time_checkpoint = ?, photos = photos + ? "
+            "WHERE id = ?",
+            (int(time.time()), photos, import_id),
+        )
+
+    def finish(self, import_id):
+        self.db.execute(
+            "UPDATE IPhotoImportTable SET finished = 1 WHERE id = ?", (import_id,)
+        )
+
+    def is_empty(self, import_id):
+        # True if the import changed no rows: it inserted no photos and
+        # IPhotoImportRowTable records nothing else it did.
+        cursor = self.db.execute(
+            "SELECT photos = 0 AND NOT EXISTS (SELECT 1 FROM IPhotoImportRowTable "
+            "WHERE import_id = :id) FROM IPhotoImportTable WHERE id = :id",
+            {"id": import_id},
+        )
+        row = cursor.fetchone()
+        return bool(row and row[0])
+
+    def imports(self):
+        cursor = self.db.execute(
+            "SELECT id, iphoto_dir, time_started, time_checkpoint, photos, finished "
+            "FROM IPhotoImportTable ORDER BY id"
+        )
+        return cursor.fetchall()
+
+    def delete(self, import_id):
+        self.db.execute("DELETE FROM IPhotoImportTable WHERE id = ?", (import_id,))
+
+    def init(self):
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS IPhotoImportTable ("
+            "id INTEGER PRIMARY KEY, "
+            "iphoto_dir TEXT NOT NULL, "
+            "time_started INTEGER, "
+            "time_checkpoint INTEGER, "
+            "photos INTEGER, "
+            "finished INTEGER "
+            ")"
+        )
+
+
+# The ImportRowTable is not part of Shotwell's schema either.  It records the
+# events and backing photos created by each import, photos are recorded by
+# their import_id already, and the previous editable_id of the photos of
+# earlier imports whose modified version it changed, so an import can be
+# rolled back exactly.
+#           import_id = 1348941635
+#          table_name = EventTable
+#              row_id = 3
+#            previous = NULL
+
+
+class ImportRowTable:
+    def __init__(self, db):
+        self.db = db
+        self.init()
+
+    def add(self, import_id, table_name, row_ids):
+        self.db.executemany(
+            "INSERT INTO IPhotoImportRowTable (import_id, table_name, row_id) "
+            "VALUES (?, ?, ?)",
+            ((import_id, table_name, row_id) for row_id in row_ids),
+        )
+
+    def add_updated(self, import_id, table_name, rows):
+        # rows are the (row_id, previous) pairs of the updated rows.
+        self.db.executemany(
+            "INSERT INTO IPhotoImportRowTable "
+            "(import_id, table_name, row_id, previous) VALUES (?, ?, ?, ?)",
+            ((import_id, table_name, row_id, previous) for row_id, previous in rows),
+        )
+
+    def delete(self, import_id):
+        self.db.execute(
+            "DELETE FROM IPhotoImportRowTable WHERE import_id = ?", (import_id,)
+        )
+
+    def init(self):
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS IPhotoImportRowTable ("
+            "import_id INTEGER NOT NULL, "
+            "table_name TEXT NOT NULL, "
+            "row_id INTEGER NOT NULL, "
+            "previous INTEGER"
+            ")"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS IPhotoImportRowIndex "
+            "ON IPhotoImportRowTable (import_id)"
+        )
+
+
+# The SyncTable is not part of Shotwell's schema either.  It holds a digest of
+# the ImagePath and OriginalPath of each Master Image List entry as the last
+# sync of a library saw it, see SyncState.
+#          iphoto_dir = /home/shaun/iPhoto Library
+#                 key = 1234
+#              digest = -5764607523034234880
+
+
+class SyncTable:
+    def __init__(self, db):
+        self.db = db
+        self.init()
+
+    def digests(self, iphoto_dir):
+        cursor = self.db.execute(
+            "SELECT key, digest FROM IPhotoSyncTable WHERE iphoto_dir = ?",
+            (iphoto_dir,),
+        )
+        return dict(cursor)
+
+    def save(self, iphoto_dir, digests):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO IPhotoSyncTable (iphoto_dir, key, digest) "
+            "VALUES (?, ?, ?)",
+            ((iphoto_dir, key, digest) for key, digest in digests),
+        )
+
+    def forget(self, iphoto_dir):
+        self.db.execute(
+            "DELETE FROM IPhotoSyncTable WHERE iphoto_dir = ?", (iphoto_dir,)
+        )
+
+    def init(self):
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS IPhotoSyncTable ("
+            "iphoto_dir TEXT NOT NULL, "
+            "key INTEGER NOT NULL, "
+            "digest INTEGER NOT NULL, "
+            "PRIMARY KEY (iphoto_dir, key)"
+            ")"
+        )
+
+
+def rollback_import(db, import_id):
+    """Delete the rows inserted by an import.
+
+    Its photos and videos go, and so do the backing photos and events it
+    created unless something else uses them by now, e.g. photos moved to one
+    of the events in Shotwell.  Photos of earlier imports whose modified
+    version it changed get their previous one back.  Returns the number of
+    photos, videos, backing photos and events deleted and of photos
+    restored.
+    """
+    created = (
+        "SELECT row_id FROM IPhotoImportRowTable "
+        "WHERE import_id = :import_id AND table_name = '%s'"
+    )
+    params = {"import_id": import_id}
+    photos = db.execute(
+        "DELETE FROM PhotoTable WHERE import_id = :import_id", params
+    ).rowcount
+    # Before the backing photos, the ones the import pointed photos at are
+    # no longer in use then.
+    restored = db.execute(
+        "UPDATE PhotoTable SET editable_id = ("
+        "SELECT previous FROM IPhotoImportRowTable r "
+        "WHERE r.import_id = :import_id AND r.table_name = 'PhotoTable' "
+        "AND r.row_id = PhotoTable.id) "
+        "WHERE id IN (%s)" % (created % "PhotoTable"),
+        params,
+    ).rowcount
+    backing_photos = db.execute(
+        "DELETE FROM BackingPhotoTable WHERE id IN (%s) "
+        "AND id NOT IN (SELECT editable_id FROM PhotoTable "
+        "WHERE editable_id IS NOT NULL)" % (created % "BackingPhotoTable"),
+        params,
+    ).rowcount
+    # NOT IN is never true if the subquery yields a NULL.
+    in_use = "SELECT event_id FROM PhotoTable WHERE event_id IS NOT NULL"
+    videos = 0
+    cursor = db.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type='table' AND name='VideoTable'"
+    )
+    if cursor.fetchone()[0]:
+        videos = db.execute(
+            "DELETE FROM VideoTable WHERE import_id = :import_id", params
+        ).rowcount
+        in_use += " UNION SELECT event_id FROM VideoTable WHERE event_id IS NOT NULL"
+    events = db.execute(
+        "DELETE FROM EventTable WHERE id IN (%s) AND id NOT IN (%s)"
+        % (created % "EventTable", in_use),
+        params,
+    ).rowcount
+    # The next sync of the library looks at every entry again, the ones that
+    # are still imported are skipped as usual.
+    cursor = db.execute(
+        "SELECT iphoto_dir FROM IPhotoImportTable WHERE id = :import_id", params
+    )
+    for (iphoto_dir,) in cursor.fetchall():
+        SyncTable(db).forget(iphoto_dir)
+    ImportRowTable(db).delete(import_id)
+    ImportTable(db).delete(import_id)
+    return photos, videos, backing_photos, events, restored
@@ -1,45 +1,228 @@
+import collections
+import errno
+import fcntl
 import hashlib
 import os
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import logging
 
 logger = logging.getLogger("iphotoimport")
 
+# Linux ioctl cloning a file's extents (reflink) on btrfs, XFS, ...
+FICLONE = 0x40049409
+
+# Errors meaning a kernel copy method isn't available for this pair of files.
+UNSUPPORTED_ERRNOS = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP}
+
+# Number of threads linking and copying files by default.  Copies are
+# I/O-bound, so this is independent of the number of CPUs.
+DEFAULT_COPY_JOBS = 8
+
+# A file to link or copy.  md5 and size are those of src if they are known,
+# copied is True if dst has already been written while src was hashed, which
+# took seconds.
+Copy = collections.namedtuple(
+    "Copy",
+    ("src", "dst", "md5", "size", "copied", "seconds"),
+    defaults=(None, None, False, 0.0),
+)
+
 
 class FileSystem:
     def __init__(self, forceCopy):
         self.forceCopy = forceCopy
+        # Directories known to exist, so each is only created once.
+        self.dirs = set()
+        # Kernel copy methods that failed with UNSUPPORTED_ERRNOS.
+        self.unsupported = set()
+        # Number of hard links that failed and were retried as a copy.
+        self.link_failures = 0
+        # st_dev of the destination directories, see needs_copy().
+        self.dir_devs = {}
 
-    def safe_link_file(self, src, dst):
-        assert os.path.exists(src), "%s didn't exist" % src
-
+    def safe_link_file(self, src, dst, md5=None):
+        # Returns the number of bytes copied, 0 if dst was linked or was
+        # already there.  md5 is the hash of src, if it's known already.
+        self.mkdir(dst)
         if self.forceCopy:
-            self.mkdir(dst)
-            shutil.copy(src, dst)
-            return
+            return self.copy_file(src, dst)
 
-        if os.path.exists(dst):
-            if self.is_file_same(src, dst):
+        # Try to link the file
+        try:
+            os.link(src, dst)
+            return 0
+        except FileExistsError:
+            if self.is_file_same(src, dst, md5):
                 # Nothing to do
+                return 0
+            raise Exception(
+                "Destination file %s exists and not equal to %s" % (dst, src)
+            )
+        except OSError:
+            if not os.path.exists(src):
+                raise AssertionError("%s didn't exist" % src)
+            logger.debug("Hard link failed, falling back on copy")
+            self.link_failures += 1
+            return self.copy_file(src, dst)
+
+    def copy_file(self, src, dst):
+        # Copies the bytes of src to dst letting the kernel do the work: a
+        # reflink if the filesystem supports it, otherwise copy_file_range()
+        # or sendfile(), which avoid passing the data through Python.  The copy
+        # is renamed into place so dst is never left half written, nor is a
+        # previous hard link to src truncated.  It keeps the mtime of src,
+        # which the Shotwell DB records as the file's timestamp.
+        tmp = dst + ".part"
+        try:
+            with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+                size = os.fstat(fsrc.fileno()).st_size
+                if not self._reflink(fsrc, fdst):
+                    self._copy_range(fsrc, fdst, size)
+            shutil.copystat(src, tmp)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        os.replace(tmp, dst)
+        return size
+
+    def _reflink(self, fsrc, fdst):
+        if "reflink" in self.unsupported:
+            return False
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except OSError as e:
+            if e.errno in UNSUPPORTED_ERRNOS or e.errno == errno.ENOTTY:
+                # Only remember it for the whole run if the filesystem can't do
+                # it at all, a cross-device clone may work for other pairs.
+                if e.errno != errno.EXDEV:
+                    self.unsupported.add("reflink")
+                return False
+            raise
+
+    def _copy_range(self, fsrc, fdst, size):
+        for method in ("copy_file_range", "sendfile"):
+            if method in self.unsupported or not hasattr(os, method):
+                continue
+            copy = getattr(os, method)
+            offset = 0
+            try:
+                while offset < size:
+                    if method == "copy_file_range":
+                        n = copy(fsrc.fileno(), fdst.fileno(), size - offset)
+                    else:
+                        n = copy(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+                    if n == 0:
+                        break
+                    offset += n
                 return
-            else:
-                raise Exception(
-                    "Destination file %s exists and not equal to %s" % (dst, src)
-                )
-        else:
-            self.mkdir(dst)
-            # Try to link the file
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS or offset:
+                    raise
+                self.unsupported.add(method)
+        shutil.copyfileobj(fsrc, fdst)
+
+    def is_file_same(self, f1, f2, md5=None):
+        # Cheapest checks first: the same inode, then the sizes.  If the md5
+        # of f1 is already known only f2 is hashed, otherwise both files are
+        # compared block by block, stopping at the first difference.
+        st1 = os.stat(f1)
+        st2 = os.stat(f2)
+        if (st1.st_dev, st1.st_ino) == (st2.st_dev, st2.st_ino):
+            return True
+        if st1.st_size != st2.st_size:
+            return False
+        if md5 is not None:
+            return self.md5_for_file(f2) == md5
+        return self.compare_files(f1, f2)
+
+    def compare_files(self, f1, f2, block_size=2**20):
+        with open(f1, "rb") as a, open(f2, "rb") as b:
+            while True:
+                data = a.read(block_size)
+                if data != b.read(block_size):
+                    return False
+                if not data:
+                    return True
+
+    def link_duplicate(self, first, dst, copied=False):
+        # Makes dst a hard link to first, an earlier copy of the same bytes.
+        # A dst written by read_file() is replaced, any other existing dst is
+        # left to safe_link_file().  Returns False if dst wasn't linked.
+        if os.path.exists(dst):
+            if os.path.samefile(first, dst):
+                return True
+            if not copied:
+                return False
+        self.mkdir(dst)
+        tmp = dst + ".part"
+        try:
+            os.link(first, tmp)
+        except OSError:
+            return False
+        os.replace(tmp, dst)
+        return True
+
+    def needs_copy(self, src, dst, src_dev=None):
+        # True if dst doesn't exist yet and can't be hard linked to src, i.e.
+        # safe_link_file() would end up copying the bytes.  src_dev is the
+        # st_dev of src if it's known.
+        if self.forceCopy:
+            return True
+        if os.path.exists(dst):
+            return False
+        if src_dev is None:
+            src_dev = os.stat(src).st_dev
+        return src_dev != self.dir_dev(os.path.dirname(dst))
+
+    def dir_dev(self, dir):
+        # st_dev of the file system dir is or will be created on, i.e. of its
+        # closest existing ancestor.
+        dev = self.dir_devs.get(dir)
+        if dev is None:
             try:
-                os.link(src, dst)
-            except:
-                logger.debug("Hard link failed, falling back on copy")
-                shutil.copy(src, dst)
-
-    def is_file_same(self, f1, f2):
-        return os.path.samefile(f1, f2) or self.md5_for_file(f1) == self.md5_for_file(
-            f2
-        )
+                dev = os.stat(dir).st_dev
+            except FileNotFoundError:
+                dev = self.dir_dev(os.path.dirname(dir))
+            self.dir_devs[dir] = dev
+        return dev
+
+    def read_file(self, src, dst=None, block_size=2**20):
+        # Reads src once, hashing it and, if dst is given, copying it there at
+        # the same time.  Returns the md5 and the first block of the file so
+        # the caller can probe the headers without reading src again.
+        md5 = hashlib.md5()
+        head = None
+        out = None
+        if dst is not None:
+            self.mkdir(dst)
+            tmp = dst + ".part"
+            out = open(tmp, "wb")
+        try:
+            with open(src, "rb") as f:
+                while True:
+                    data = f.read(block_size)
+                    if head is None:
+                        head = data
+                    if not data:
+                        break
+                    md5.update(data)
+                    if out is not None:
+                        out.write(data)
+        except BaseException:
+            if out is not None:
+                out.close()
+                os.unlink(tmp)
+            raise
+        if out is not None:
+            out.close()
+            shutil.copystat(src, tmp)
+            os.replace(tmp, dst)
+        return md5.hexdigest(), head
 
     def md5_for_file(self, filename, block_size=2**20):
         with open(filename, "rb") as f:
@@ -52,7 +235,98 @@ class FileSystem:
         return md5.hexdigest()
 
     def mkdir(self, dir):
-        try:
-            os.makedirs(os.path.dirname(dir))
-        except Exception:
-            pass
+        parent = os.path.dirname(dir)
+        if parent not in self.dirs:
+            os.makedirs(parent, exist_ok=True)
+            self.dirs.add(parent)
+
+
+class CopyEngine:
+    """Links or copies batches of Copy entries on a thread pool.
+
+    When files are copied rather than linked, the destination of the first
+    copy of each (size, md5) is remembered and later files with the same
+    content are hard linked to it, so the destination only holds one copy
+    of each distinct file.  Keeps count of the bytes copied, the bytes saved
+    that way and the time spent so the throughput can be reported.  The
+    bytes and time of the copies done while hashing, see
+    FileSystem.read_file(), are counted too.
+    """
+
+    def __init__(self, fs, jobs=DEFAULT_COPY_JOBS):
+        self.fs = fs
+        self.jobs = jobs
+        self.files = 0
+        self.bytes = 0
+        self.saved = 0
+        self.seconds = 0.0
+        self.first_copies = {}  # (size, md5) -> dst
+
+    def copy(self, entries):
+        if not entries:
+            return
+        start = time.monotonic()
+        pending = []
+        duplicates = []
+        for entry in entries:
+            if entry.copied:
+                # Written by the prober, whether it's linked to a duplicate
+                # below or not.
+                self.bytes += entry.size
+                self.seconds += entry.seconds
+            if self.deduplicate(entry, duplicates):
+                continue
+            if not entry.copied:
+                pending.append(entry)
+        # Create the directories up front so the threads don't race for them.
+        for entry in pending:
+            self.fs.mkdir(entry.dst)
+        if self.jobs <= 1:
+            results = [self._link_or_copy(entry) for entry in pending]
+        else:
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                results = list(executor.map(self._link_or_copy, pending))
+        # The first copies are all in place now.
+        for first, entry in duplicates:
+            if self.fs.link_duplicate(first, entry.dst, entry.copied):
+                self.saved += entry.size
+            elif not entry.copied:
+                results.append(self._link_or_copy(entry))
+        self.files += len(entries)
+        self.bytes += sum(results)
+        self.seconds += time.monotonic() - start
+
+    def deduplicate(self, entry, duplicates):
+        # Returns True, and adds entry to duplicates, if its bytes would be
+        # copied and a copy of them already is in the destination.
+        if entry.md5 is None or entry.size is None:
+            return False
+        if not (entry.copied or self.fs.needs_copy(entry.src, entry.dst)):
+            # Hard links to the source cost no space.
+            return False
+        key = (entry.size, entry.md5)
+        first = self.first_copies.setdefault(key, entry.dst)
+        if first == entry.dst:
+            return False
+        duplicates.append((first, entry))
+        return True
+
+    def _link_or_copy(self, entry):
+        return self.fs.safe_link_file(entry.src, entry.dst, entry.md5)
+
+    def rate(self):
+        # Bytes copied per second so far.
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def report(self):
+        logger.info(
+            "Linked or copied %s files, copied %.1f MB at %.1f MB/s",
+            self.files,
+            self.bytes / 2**20,
+            self.rate() / 2**20,
+        )
+        if self.saved:
+            logger.info(
+                "Linked duplicate files instead of copying them, saved %.1f MB",
+                self.saved / 2**20,
+            )
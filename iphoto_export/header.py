@@ -0,0 +1,180 @@
+import datetime
+import struct
+
+# EXIF tags of IFD0 read from the headers.
+TAG_IMAGE_WIDTH = 0x0100
+TAG_IMAGE_LENGTH = 0x0101
+TAG_ORIENTATION = 0x0112
+TAG_DATETIME = 0x0132
+IFD0_TAGS = (TAG_IMAGE_WIDTH, TAG_IMAGE_LENGTH, TAG_ORIENTATION, TAG_DATETIME)
+
+# Size in bytes of the TIFF field types, by type id.
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8}
+
+# JPEG start of frame markers, i.e. all SOFn but DHT, JPG and DAC.
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers without a length, TEM, RST0-7 and SOI.
+JPEG_STANDALONE_MARKERS = frozenset(range(0xD0, 0xD9)) | {0x01}
+JPEG_SOS = 0xDA
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Text chunk keywords ImageMagick and exiv2 use to store EXIF in PNGs.
+PNG_EXIF_TEXT_KEYWORDS = (b"Raw profile type exif", b"Raw profile type APP1")
+
+
+class HeaderError(Exception):
+    pass
+
+
+def read_header(head, mime):
+    """Read the size, orientation and EXIF date of an image from its header.
+
+    head is the start of the file, usually its first block.  Returns a dict
+    with width, height, orientation and datetime (the raw Exif.Image.DateTime
+    value: a datetime, the string if it isn't a valid date, or None) or None
+    if the header can't be parsed from head alone, in which case the caller
+    should fall back to decoding the file.
+    """
+    parse = HEADER_PARSERS.get(mime)
+    if parse is None or not head:
+        return None
+    header = {"orientation": 1, "datetime": None}
+    try:
+        parse(head, header)
+    except (HeaderError, struct.error, IndexError, KeyError):
+        return None
+    return header
+
+
+def _jpeg(head, header):
+    if head[:2] != b"\xff\xd8":
+        raise HeaderError("not a JPEG")
+    pos = 2
+    while True:
+        if head[pos] != 0xFF:
+            raise HeaderError("expected a marker at %d" % pos)
+        # Markers may be preceded by any number of 0xFF fill bytes.
+        while head[pos] == 0xFF:
+            pos += 1
+        marker = head[pos]
+        pos += 1
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker == JPEG_SOS:
+            # The frame header comes before the scans.
+            raise HeaderError("no SOF before the image data")
+        (length,) = struct.unpack_from(">H", head, pos)
+        if marker == 0xE1 and head[pos + 2 : pos + 8] == b"Exif\x00\x00":
+            _exif(head[pos + 8 : pos + length], header)
+        elif marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack_from(">HH", head, pos + 3)
+            header["width"] = width
+            header["height"] = height
+            return
+        pos += length
+
+
+def _png(head, header):
+    if not head.startswith(PNG_SIGNATURE):
+        raise HeaderError("not a PNG")
+    pos = len(PNG_SIGNATURE)
+    while True:
+        length, chunk_type = struct.unpack_from(">I4s", head, pos)
+        data = head[pos + 8 : pos + 8 + length]
+        if len(data) < length:
+            raise HeaderError("truncated %s chunk" % chunk_type)
+        if chunk_type == b"IHDR":
+            header["width"], header["height"] = struct.unpack_from(">II", data)
+        elif chunk_type == b"eXIf":
+            _exif(data, header)
+        elif chunk_type in (b"tEXt", b"zTXt", b"iTXt") and data.startswith(
+            PNG_EXIF_TEXT_KEYWORDS
+        ):
+            raise HeaderError("EXIF in a text chunk")
+        elif chunk_type in (b"IDAT", b"IEND"):
+            # EXIF after the image data is ignored, as by exiv2.
+            if "width" not in header:
+                raise HeaderError("no IHDR chunk")
+            return
+        pos += 12 + length
+
+
+def _tiff(head, header):
+    tags = _ifd0(head)
+    header["width"] = tags[TAG_IMAGE_WIDTH]
+    header["height"] = tags[TAG_IMAGE_LENGTH]
+    _exif_tags(tags, header)
+
+
+def _bmp(head, header):
+    if head[:2] != b"BM":
+        raise HeaderError("not a BMP")
+    (dib_size,) = struct.unpack_from("<I", head, 14)
+    if dib_size == 12:
+        # OS/2 BITMAPCOREHEADER
+        width, height = struct.unpack_from("<HH", head, 18)
+    else:
+        width, height = struct.unpack_from("<ii", head, 18)
+    header["width"] = width
+    # Top-down bitmaps have a negative height.
+    header["height"] = abs(height)
+
+
+def _exif(data, header):
+    _exif_tags(_ifd0(data), header)
+
+
+def _exif_tags(tags, header):
+    if TAG_ORIENTATION in tags:
+        header["orientation"] = tags[TAG_ORIENTATION]
+    if TAG_DATETIME in tags:
+        value = tags[TAG_DATETIME]
+        try:
+            header["datetime"] = datetime.datetime.strptime(value, "%Y:%m:%d %H:%M:%S")
+        except ValueError:
+            # Like pyexiv2, leave dates it can't parse to the caller.
+            header["datetime"] = value
+
+
+def _ifd0(data):
+    # Reads the tags of the first IFD of the TIFF structure in data.
+    if data[:4] == b"II*\x00":
+        order = "<"
+    elif data[:4] == b"MM\x00*":
+        order = ">"
+    else:
+        raise HeaderError("not a TIFF structure")
+    (offset,) = struct.unpack_from(order + "I", data, 4)
+    (count,) = struct.unpack_from(order + "H", data, offset)
+    tags = {}
+    for i in range(count):
+        entry = offset + 2 + 12 * i
+        tag, field_type, n = struct.unpack_from(order + "HHI", data, entry)
+        if tag not in IFD0_TAGS:
+            continue
+        size = TIFF_TYPE_SIZES.get(field_type, 1) * n
+        if size > 4:
+            (value_offset,) = struct.unpack_from(order + "I", data, entry + 8)
+        else:
+            value_offset = entry + 8
+        if value_offset + size > len(data):
+            raise HeaderError("tag %#x is outside of the header" % tag)
+        if field_type == 2:
+            value = data[value_offset : value_offset + n].split(b"\x00")[0]
+            tags[tag] = value.decode("ascii", "replace").strip()
+        elif field_type == 3:
+            (tags[tag],) = struct.unpack_from(order + "H", data, value_offset)
+        elif field_type == 4:
+            (tags[tag],) = struct.unpack_from(order + "I", data, value_offset)
+        else:
+            raise HeaderError("unexpected type %d of tag %#x" % (field_type, tag))
+    return tags
+
+
+HEADER_PARSERS = {
+    "image/jpeg": _jpeg,
+    "image/png": _png,
+    "image/tiff": _tiff,
+    "image/bmp": _bmp,
+    "image/x-ms-bmp": _bmp,
+}
@@ -16,21 +16,70 @@
 
 import sqlite3
 import argparse
+import collections
+import datetime
+import json
 import logging
 from os.path import join as join_path
 import os.path
 import sys
 import time
-import shutil
-import plistlib
-import datetime
-from PIL import Image  # @UnresolvedImport
-from pyexiv2.metadata import ImageMetadata
-import mimetypes
-import re
 
-from iphoto_export.database import BackingPhotoTable
-from iphoto_export.fs import FileSystem
+from iphoto_export.album_data import (
+    ARCHIVE_PATH,
+    PHOTO,
+    ROLL,
+    SKIP_IMPORTED,
+    AlbumDataError,
+    ArchivePaths,
+    KeySet,
+    Selection,
+    entry_skip,
+    located_photos,
+    parse_date,
+    read_album_data,
+)
+from iphoto_export.cache import DEFAULT_MAX_ENTRIES, ProbeCache
+from iphoto_export.database import (
+    FAST_IMPORT_PRAGMAS,
+    Backup,
+    BackingPhotoTable,
+    EventTable,
+    ImportRowTable,
+    ImportTable,
+    PhotoTable,
+    VideoTable,
+    backup_filename,
+    import_pragmas,
+)
+from iphoto_export.fs import DEFAULT_COPY_JOBS, CopyEngine, FileSystem
+from iphoto_export.metrics import (
+    BACKUP,
+    COPY,
+    DB_INSERT,
+    EVENT_BUILD,
+    PLIST_PARSE,
+    PROBE,
+    SCAN,
+    THUMBNAILS,
+    Metrics,
+    Progress,
+)
+from iphoto_export.photo import Video
+from iphoto_export.pipeline import Pipeline
+from iphoto_export.plan import log_plan, plan_import
+from iphoto_export.probe import (  # noqa: F401
+    FILE_FORMAT,
+    SKIP_MISSING,
+    SKIP_NO_EVENT,
+    PhotoProber,
+    exif_datetime_to_time,
+    photo_task,
+    probe_photos,
+)
+from iphoto_export.scan import DEFAULT_SCAN_JOBS, StatIndex
+from iphoto_export.sync import DEFAULT_WATCH_INTERVAL, SyncState, watch
+from iphoto_export.thumbnails import DEFAULT_THUMBNAIL_DIR, write_thumbnails
 
 # Shotwell's orientation enum
 
@@ -43,44 +92,60 @@ RIGHT_TOP = 6
 RIGHT_BOTTOM = 7
 LEFT_BOTTOM = 8
 
-FILE_FORMAT = {
-    "image/jpeg": 0,
-    # Raw = 1
-    "image/png": 2,
-    "image/tiff": 3,
-    "image/x-ms-bmp": 4,
-}
-
 _log = logging.getLogger("iphotoimport")
 
 SUPPORTED_SHOTWELL_SCHEMAS = (16, 20)
 
-
-def exif_datetime_to_time(dt):
-    if isinstance(dt, str):
-        # Looks like the exif lib couldn't parse the date.  I've seen dates
-        # like 2007:00:00 00:00:00.  Let's try that.
-        match = re.match(r"(\d{4}):(\d\d):(\d\d) (\d\d):(\d\d):(\d\d)", dt)
-        if match:
-            y, m, d, h, mn, s = [int(x) for x in match.groups()]
-            m += 1  # datetime uses 1-indexed months/days
-            assert m <= 12
-            d += 1
-            assert d <= 31
-            dt = datetime.datetime(y, m, d, h, mn, s)
-        else:
-            raise Exception("Failed to parse date %s" % dt)
-
-    return int(time.mktime(dt.timetuple()))
-
-
-def import_photos(iphoto_dir, shotwell_db, photos_dir, force_copy):
+# Photos handed to the copy and insert stages by flush(): the (photo,
+# event) pairs to insert, the imported photos whose modified version changed,
+# the events to insert first and the files to link or copy.
+Batch = collections.namedtuple("Batch", ("ready", "updated", "new_events", "copies"))
+
+# Number of photos inserted and copied per transaction.
+DEFAULT_BATCH_SIZE = 1000
+
+
+def import_photos(
+    iphoto_dir,
+    shotwell_db,
+    photos_dir,
+    force_copy,
+    jobs=1,
+    probe_cache=None,
+    probe_cache_size=DEFAULT_MAX_ENTRIES,
+    batch_size=DEFAULT_BATCH_SIZE,
+    pragmas=(),
+    copy_jobs=DEFAULT_COPY_JOBS,
+    thumbnail_dir=None,
+    metrics=None,
+    pipelined=False,
+    scan_jobs=DEFAULT_SCAN_JOBS,
+    backup=True,
+    selection=None,
+    sync_state=None,
+):
     _log.debug("Arguments")
     _log.debug("\t- iPhoto dir   : %s", iphoto_dir)
     _log.debug("\t- Shotwell db  : %s", shotwell_db)
     _log.debug("\t- Shotwell dir : %s", photos_dir)
     _log.debug("\t- force copy   : %s", force_copy)
+    _log.debug("\t- jobs         : %s", jobs)
+    _log.debug("\t- probe cache  : %s", probe_cache)
+    _log.debug("\t- batch size   : %s", batch_size)
+    _log.debug("\t- pragmas      : %s", pragmas)
+    _log.debug("\t- copy jobs    : %s", copy_jobs)
+    _log.debug("\t- thumbnails   : %s", thumbnail_dir)
+    _log.debug("\t- pipelined    : %s", pipelined)
+    _log.debug("\t- scan jobs    : %s", scan_jobs)
+    _log.debug("\t- backup       : %s", backup)
+    _log.debug("\t- selection    : %s", selection)
+    _log.debug("\t- sync         : %s", sync_state is not None)
+    if metrics is None:
+        metrics = Metrics()
+    if selection is None:
+        selection = Selection()
     fs = FileSystem(force_copy)
+    copier = CopyEngine(fs, copy_jobs)
     # Sanity check the iPhoto dir and Shotwell DB.
     _log.debug("Performing sanity checks on iPhoto and Shotwell DBs.")
     now = int(time.time())
@@ -94,7 +159,8 @@ def import_photos(iphoto_dir, shotwell_db, photos_dir, force_copy):
     if not os.path.exists(shotwell_db):
         _log.error("Shotwell DB not found at %s", shotwell_db)
         sys.exit(2)
-    db = sqlite3.connect(shotwell_db)  # @UndefinedVariable
+    # The insert stage of the pipeline uses the connection from its own thread.
+    db = sqlite3.connect(shotwell_db, check_same_thread=False)  # @UndefinedVariable
     backingPhotoTable = BackingPhotoTable(db)
     with db:
         cursor = db.execute("SELECT schema_version from VersionTable;")
@@ -108,32 +174,79 @@ def import_photos(iphoto_dir, shotwell_db, photos_dir, force_copy):
             sys.exit(3)
         _log.debug("Sanity checks passed.")
 
-        # Back up the Shotwell DB.
-        fmt_now = time.strftime("%Y-%m-%d_%H%M%S")
-        db_backup = "%s.iphotobak_%s" % (shotwell_db, fmt_now)
-        _log.debug("Backing up shotwell DB to %s", db_backup)
-        shutil.copy(shotwell_db, db_backup)
-        _log.debug("Backup complete")
+        # The iPhoto DB is parsed incrementally while the photos are imported,
+        # see the loop below.
+        paths = None
+
+        photoTable = PhotoTable(db, schema_version)
+        videoTable = VideoTable(db, schema_version)
+        eventTable = EventTable(db)
+        importTable = ImportTable(db)
+        importRowTable = ImportRowTable(db)
+        if sync_state is not None:
+            sync_state.begin(db)
+
+        # Whatever earlier, possibly interrupted, imports already inserted is
+        # skipped before any of its files is touched.
+        imported_photos = photoTable.filenames() | videoTable.filenames()
+        imported_backing_photos = backingPhotoTable.filepaths()
+        imported_events = eventTable.ids()
+        already_imported = 0
+
+        import_id = importTable.unfinished(iphoto_dir)
+        if import_id is None:
+            import_id = importTable.start(now, iphoto_dir)
+        else:
+            _log.info("Resuming interrupted import %s", import_id)
+        db.commit()
 
-        # Load and parse the iPhoto DB.
-        _log.debug(
-            "Loading the iPhoto library file. Might take a while for a large DB!"
-        )
-        album_data = plistlib.readPlist(album_data_filename)
-        _log.debug("Finished loading the iPhoto library.")
-        path_prefix = album_data["Archive Path"]
-
-        def fix_prefix(path, new_prefix=iphoto_dir):
-            if path:
-                if path[: len(path_prefix)] != path_prefix:
-                    raise AssertionError(
-                        "Path %s didn't begin with %s" % (path, path_prefix)
-                    )
-                path = path[len(path_prefix) :]
-                path = join_path(new_prefix, path.strip(os.path.sep))
-            return path
-
-        photos = {}  # Map from photo ID to photo info.
+        # Back up the Shotwell DB.  The copy runs in the background until the
+        # first batch is inserted.  A resumed import keeps the backup taken
+        # when it first started.
+        db_backup = backup_filename(shotwell_db, import_id)
+        backup_job = None
+        if not backup:
+            if pragmas:
+                _log.warning(
+                    "Importing with %s without a backup, a crash may corrupt "
+                    "the Shotwell DB",
+                    ", ".join(name for name, value in pragmas),
+                )
+            _log.info(
+                "Not backing up the Shotwell DB, undo the import with "
+                "python -m iphoto_export.rollback %s",
+                import_id,
+            )
+        elif os.path.exists(db_backup):
+            _log.info("Backup of the Shotwell DB already taken at %s", db_backup)
+        else:
+            _log.debug("Backing up shotwell DB to %s", db_backup)
+            backup_job = Backup(shotwell_db, db_backup).start()
+
+        def wait_for_backup():
+            nonlocal backup_job
+            if backup_job is not None:
+                with metrics.timer(BACKUP):
+                    backup_job.wait()
+                _log.debug("Backup complete")
+                backup_job = None
+
+        # The library's directories are listed up front so the missing files
+        # are known without a syscall, only the files probed are stat'ed.  A
+        # sync only looks at the few files that changed, they're stat'ed, and
+        # a partial import only lists what it selects.
+        with metrics.timer(SCAN):
+            if sync_state is not None and sync_state.warm:
+                stat_index = StatIndex()
+            else:
+                stat_index = StatIndex.for_library(iphoto_dir, scan_jobs, selection)
+        metrics.count(SCAN, "directories", len(stat_index.dirs))
+        metrics.count(SCAN, "files", stat_index.files)
+
+        events = {}
+        batch = []  # Probed photos waiting to be inserted.
+        # Keys of the entries whose paths changed since the last sync.
+        changed_keys = set()
         copy_queue = []
 
         #                  id = 224
@@ -165,250 +278,269 @@ def import_photos(iphoto_dir, shotwell_db, photos_dir, force_copy):
         #   develop_camera_id = -1
         # develop_embedded_id = -1
         skipped = []
-        for key, i_photo in list(album_data["Master Image List"].items()):
-            mod_image_path = fix_prefix(i_photo.get("ImagePath", None))
-            orig_image_path = fix_prefix(i_photo.get("OriginalPath", None))
 
-            new_mod_path = fix_prefix(i_photo.get("ImagePath"), new_prefix=photos_dir)
-            new_orig_path = fix_prefix(
-                i_photo.get("OriginalPath", None), new_prefix=photos_dir
+        def photo_tasks(album_data):
+            nonlocal paths
+            try:
+                for kind, key, value in located_photos(
+                    metrics.timed(PLIST_PARSE, read_album_data(album_data))
+                ):
+                    if kind == PHOTO:
+                        if wanted(key, value):
+                            yield photo_task(key, value, paths, stat_index)
+                    elif kind == ROLL:
+                        if not selection.roll(value):
+                            # None of its photos is imported.
+                            continue
+                        with metrics.timer(EVENT_BUILD):
+                            events[value["RollID"]] = {
+                                "date": parse_date(value["RollDateAsTimerInterval"]),
+                                "key_photo": value["KeyPhotoKey"],
+                                "photos": KeySet(value["KeyList"]),
+                                "name": value["RollName"],
+                            }
+                    elif key == ARCHIVE_PATH:
+                        paths = ArchivePaths(value, iphoto_dir, photos_dir)
+            except AlbumDataError as e:
+                _log.error("%s", e)
+                sys.exit(4)
+
+        def wanted(key, i_photo):
+            # Photos left out of the import are dropped before any of their
+            # files is touched.
+            nonlocal already_imported
+            reason = entry_skip(
+                key,
+                i_photo,
+                paths,
+                selection,
+                imported_photos,
+                sync_state,
+                changed_keys,
             )
-
-            if not orig_image_path or not os.path.exists(mod_image_path):
-                orig_image_path = mod_image_path
-                new_orig_path = new_mod_path
-                new_mod_path = None
-                mod_image_path = None
-                mod_file_size = None
-            else:
-                mod_file_size = os.path.getsize(mod_image_path)
-
-            if not os.path.exists(orig_image_path):
-                _log.error("Original file not found %s", orig_image_path)
-                skipped.append(orig_image_path)
-                continue
-
-            copy_queue.append((orig_image_path, new_orig_path))
-            if mod_image_path:
-                copy_queue.append((mod_image_path, new_mod_path))
-
-            mime, _ = mimetypes.guess_type(orig_image_path)
-
-            sys.stdout.write(".")
-            sys.stdout.flush()
-            if mime not in ("image/jpeg", "image/png", "image/x-ms-bmp", "image/tiff"):
-                print()
-                _log.error(
-                    "Skipping %s, it's not an image, it's a %s", orig_image_path, mime
+            if reason is None:
+                return True
+            if reason == SKIP_IMPORTED:
+                already_imported += 1
+            metrics.skip(reason)
+            return False
+
+        def flush():
+            # Hands the photos of the batch whose roll is known over to the
+            # copy and insert stages.
+            nonlocal batch
+            waiting = []
+            ready = []
+            updated = []
+            new_events = []
+            with metrics.timer(EVENT_BUILD):
+                for key, photo in batch:
+                    if (
+                        key in changed_keys
+                        and photo["new_orig_path"] in imported_photos
+                    ):
+                        # Only the modified version of an imported photo
+                        # changes, Shotwell keeps none for movies.
+                        if not isinstance(photo, Video):
+                            updated.append(photo)
+                        continue
+                    event = events.get(photo["event"])
+                    if event is None:
+                        # The roll may still be further down in the library file.
+                        waiting.append((key, photo))
+                        continue
+                    if key not in event["photos"]:
+                        _log.error("Photo didn't have an event: %s", photo)
+                        skip(SKIP_NO_EVENT, photo["orig_image_path"], key)
+                        continue
+                    if "row_id" not in event:
+                        # The row_id of new events is set once they're inserted.
+                        event["row_id"] = imported_events.get(
+                            (event["name"], int(event["date"]))
+                        )
+                        if event["row_id"] is None:
+                            new_events.append(event)
+                    ready.append((photo, event))
+            pipeline.put(Batch(ready, updated, new_events, copy_queue[:]))
+            copy_queue.clear()
+            batch = waiting
+
+        def copy_stage(item):
+            with metrics.timer(COPY):
+                copier.copy(item.copies)
+            return item
+
+        def insert_stage(item):
+            # Inserts the photos whose files have been copied and commits, so
+            # an interrupted import resumes from here.
+            ready, updated, new_events = item.ready, item.updated, item.new_events
+            wait_for_backup()
+            # Rows are inserted table by table; the ids are allocated by
+            # insert_many() so the references between them can be filled in
+            # without reading anything back.
+            with metrics.timer(DB_INSERT):
+                eventTable.insert_many(new_events)
+                importRowTable.add(
+                    import_id, "EventTable", [event["row_id"] for event in new_events]
+                )
+                new_backing_photos = []
+                photos = []
+                videos = []
+                for photo, event in ready:
+                    photo["event_id"] = event["row_id"]
+                    photo["import_id"] = import_id
+                    if isinstance(photo, Video):
+                        videos.append(photo)
+                    else:
+                        photos.append(photo)
+                for photo in photos + updated:
+                    photo["editable_id"] = -1
+                    if photo["mod_image_path"] is not None:
+                        # This photo has a backing image
+                        editable_id = imported_backing_photos.get(photo["new_mod_path"])
+                        if editable_id is None:
+                            new_backing_photos.append(photo)
+                        else:
+                            photo["editable_id"] = editable_id
+                backingPhotoTable.insert_many(new_backing_photos)
+                importRowTable.add(
+                    import_id,
+                    "BackingPhotoTable",
+                    [photo["editable_id"] for photo in new_backing_photos],
                 )
-                skipped.append(orig_image_path)
-                continue
-
-            caption = i_photo.get("Caption", "")
-
-            img = Image.open(orig_image_path)
-            w, h = img.size
-
-            md5 = fs.md5_for_file(orig_image_path)
-            orig_timestamp = int(os.path.getmtime(orig_image_path))
-
-            mod_w, mod_h, mod_md5, mod_timestamp = None, None, None, None
-            if mod_image_path:
                 try:
-                    mod_img = Image.open(mod_image_path)
+                    photoTable.insert_many(photos)
                 except Exception:
-                    _log.error(
-                        "Failed to open modified image %s, skipping", mod_image_path
-                    )
-                    orig_image_path = mod_image_path
-                    new_orig_path = new_mod_path
-                    new_mod_path = None
-                    mod_image_path = None
-                    mod_file_size = None
-                else:
-                    mod_w, mod_h = mod_img.size
-                    mod_md5 = fs.md5_for_file(mod_image_path)
-                    mod_timestamp = int(os.path.getmtime(mod_image_path))
-
-            file_format = FILE_FORMAT.get(mime, -1)
-            if file_format == -1:
-                raise Exception("Unknown image type %s" % mime)
-
-            photo = {
-                "orig_image_path": orig_image_path,
-                "mod_image_path": mod_image_path,
-                "new_mod_path": new_mod_path,
-                "new_orig_path": new_orig_path,
-                "orig_file_size": os.path.getsize(orig_image_path),
-                "mod_file_size": mod_file_size,
-                "mod_timestamp": mod_timestamp,
-                "orig_timestamp": orig_timestamp,
-                "caption": caption,
-                "rating": i_photo["Rating"],
-                "event": i_photo["Roll"],
-                "orig_exposure_time": int(parse_date(i_photo["DateAsTimerInterval"])),
-                "width": w,
-                "height": h,
-                "mod_width": mod_w,
-                "mod_height": mod_h,
-                "orig_md5": md5,
-                "mod_md5": md5,
-                "file_format": file_format,
-                "time_created": now,
-                "import_id": now,
-            }
-
-            # May be it's available in previous versions
-            if schema_version >= 20:
-                photo["comment"] = i_photo["Comment"]
-
-            def read_metadata(path, photo, prefix="orig_"):
-                photo[prefix + "orientation"] = 1
-                photo[prefix + "original_orientation"] = 1
+                    _log.exception("Failed to insert photos %s" % photos)
+                    raise
+                importRowTable.add_updated(
+                    import_id, "PhotoTable", photoTable.set_editable_ids(updated)
+                )
                 try:
-                    meta = ImageMetadata(path)
-                    meta.read()
-                    try:
-                        photo[prefix + "orientation"] = meta[
-                            "Exif.Image.Orientation"
-                        ].value
-                        photo[prefix + "original_orientation"] = meta[
-                            "Exif.Image.Orientation"
-                        ].value
-                    except KeyError:
-                        print()
-                        _log.debug("Failed to read the orientation from %s" % path)
-                    exposure_dt = meta["Exif.Image.DateTime"].value
-                    photo[prefix + "exposure_time"] = exif_datetime_to_time(exposure_dt)
-                except KeyError:
-                    pass
+                    videoTable.insert_many(videos)
                 except Exception:
-                    print()
-                    _log.exception("Failed to read date from %s", path)
+                    _log.exception("Failed to insert videos %s" % videos)
                     raise
-
+                importTable.checkpoint(import_id, len(photos) + len(videos))
+                db.commit()
+            metrics.count(DB_INSERT, "events", len(new_events))
+            metrics.count(DB_INSERT, "backing photos", len(new_backing_photos))
+            metrics.count(DB_INSERT, "photos", len(photos))
+            metrics.count(DB_INSERT, "videos", len(videos))
+            metrics.count(DB_INSERT, "updated photos", len(updated))
+
+        def skip(reason, path, key=None):
+            skipped.append(path)
+            metrics.skip(reason)
+            if sync_state is not None and reason in (SKIP_MISSING, SKIP_NO_EVENT):
+                # The file or the roll may be there by the next sync.
+                sync_state.retry(key)
+
+        # With pipeline the batches are copied and inserted on their own
+        # threads while the next ones are probed.  Either way the rows of a
+        # batch are only committed once its files have been copied.
+        pipeline = Pipeline([copy_stage, insert_stage], threaded=pipelined)
+        with import_pragmas(db, pragmas), pipeline:
+            # The iPhoto library file is parsed here in the main process while the
+            # photos it has already yielded are probed by the workers.  Probed
+            # photos are written to the DB and committed in batches.
+            _log.debug("Streaming the iPhoto library file.")
+            cache = None
+            if probe_cache:
+                _log.debug("Using probe cache %s", probe_cache)
+                cache = ProbeCache(probe_cache, probe_cache_size)
+            prober = PhotoProber(fs, schema_version, now, probe_cache)
+            album_data = open(album_data_filename, "rb")
+            album_data_size = os.fstat(album_data.fileno()).st_size
+            progress = Progress(lambda: album_data.tell() / (album_data_size or 1))
             try:
-                read_metadata(orig_image_path, photo, "orig_")
-                photo["orientation"] = photo["orig_orientation"]
-                if mod_image_path:
-                    read_metadata(mod_image_path, photo, "mod_")
-                    photo["orientation"] = photo["mod_orientation"]
-            except Exception:
-                _log.error("**** Skipping %s" % orig_image_path)
-                skipped.append(orig_image_path)
-                continue
-
-            photos[key] = photo
-
-        events = {}
-        for event in album_data["List of Rolls"]:
-            key = event["RollID"]
-            events[key] = {
-                "date": parse_date(event["RollDateAsTimerInterval"]),
-                "key_photo": event["KeyPhotoKey"],
-                "photos": event["KeyList"],
-                "name": event["RollName"],
-            }
-            for photo_key in event["KeyList"]:
-                assert photo_key not in photos or photos[photo_key]["event"] == key
-
-        # Insert into the Shotwell DB.
-        for _, event in list(events.items()):
-            c = db.execute(
-                """
-                INSERT INTO EventTable (time_created, name) 
-                VALUES (?, ?)
-            """,
-                (event["date"], event["name"]),
-            )
-            assert c.lastrowid is not None
-            event["row_id"] = c.lastrowid
-            for photo_key in event["photos"]:
-                if photo_key in photos:
-                    photos[photo_key]["event_id"] = event["row_id"]
-
-        for key, photo in list(photos.items()):
-            if "event_id" not in photo:
+                for key, photo, copies, skipped_photo, probes, used in metrics.timed(
+                    PROBE, probe_photos(prober, photo_tasks(album_data), jobs)
+                ):
+                    copy_queue.extend(copies)
+                    progress.update()
+                    metrics.count(PROBE, "files")
+                    metrics.count(PROBE, "cache misses", len(probes))
+                    if cache:
+                        hits, stale = used
+                        cache.touch(hits)
+                        cache.forget(stale)
+                        for path, (st, probe) in probes.items():
+                            cache.put(path, st, probe)
+                    if photo is None:
+                        skip(*skipped_photo, key)
+                    else:
+                        metrics.count(
+                            PROBE,
+                            "bytes",
+                            photo["orig_file_size"] + (photo["mod_file_size"] or 0),
+                        )
+                        batch.append((key, photo))
+                        if len(batch) >= batch_size:
+                            flush()
+                progress.finish()
+            finally:
+                album_data.close()
+                if cache:
+                    cache.close()
+            _log.debug("Finished loading the iPhoto library.")
+            flush()
+            pipeline.close()
+
+            for key, photo in batch:
                 _log.error("Photo didn't have an event: %s", photo)
-                skipped.append(photo["orig_image_path"])
-                continue
-            editable_id = -1
-            if photo["mod_image_path"] is not None:
-                # This photo has a backing image
-                editable_id = backingPhotoTable.insert(photo)
-
-            photo["editable_id"] = editable_id
-            try:
-                c = db.execute(
-                    """
-                    INSERT INTO PhotoTable (filename,
-                                            width,
-                                            height,
-                                            filesize,
-                                            timestamp,
-                                            exposure_time,
-                                            orientation,
-                                            original_orientation,
-                                            import_id,
-                                            event_id,
-                                            md5,
-                                            time_created,
-                                            flags,
-                                            rating,
-                                            file_format,
-                                            title,
-                                            editable_id,
-                                            metadata_dirty,
-                                            developer,
-                                            develop_shotwell_id,
-                                            develop_camera_id,
-                                            develop_embedded_id,
-                                            comment)
-                    VALUES (:new_orig_path,
-                            :width,
-                            :height,
-                            :orig_file_size,
-                            :orig_timestamp,
-                            :orig_exposure_time,
-                            :orientation,
-                            :orig_original_orientation,
-                            :import_id,
-                            :event_id,
-                            :orig_md5,
-                            :time_created,
-                            0,
-                            :rating,
-                            :file_format,
-                            :caption,
-                            :editable_id,
-                            1,
-                            'SHOTWELL',
-                            -1,
-                            -1,
-                            -1,
-                            :comment);
-                """,
-                    photo,
-                )
-            except Exception:
-                _log.exception("Failed to insert photo %s" % photo)
-                raise
-
-        print("Skipped importing these files:\n", "\n".join(skipped), file=sys.stderr)
-        print(
-            "%s file skipped (they will still be copied)" % len(skipped),
-            file=sys.stderr,
-        )
-
-        for src, dst in copy_queue:
-            fs.safe_link_file(src, dst)
+                skip(SKIP_NO_EVENT, photo["orig_image_path"], key)
 
+            print(
+                "Skipped importing these files:\n", "\n".join(skipped), file=sys.stderr
+            )
+            print(
+                "%s file skipped (they will still be copied)" % len(skipped),
+                file=sys.stderr,
+            )
+            if already_imported:
+                _log.info("%s photos had already been imported", already_imported)
+
+            # The last flush() handed the rest of the copy queue over to the
+            # pipeline, closing it waited for the copies.
+            copier.report()
+            metrics.count(COPY, "files", copier.files)
+            metrics.count(COPY, "bytes", copier.bytes)
+            metrics.count(COPY, "deduplicated bytes", copier.saved)
+            metrics.count(COPY, "retries", fs.link_failures)
+
+        wait_for_backup()
+        importTable.finish(import_id)
+        if sync_state is not None:
+            sync_state.save(db)
         db.commit()
         # Commit the transaction.
 
+        # A run that changed nothing, e.g. a re-run on an imported library,
+        # has nothing to restore.
+        if os.path.exists(db_backup) and importTable.is_empty(import_id):
+            _log.debug("Nothing was imported, removing the backup %s", db_backup)
+            os.remove(db_backup)
+
+        # Pre-generate Shotwell's thumbnails so it doesn't have to do it on
+        # its first start.
+        if thumbnail_dir:
+            with metrics.timer(THUMBNAILS):
+                thumbnails = write_thumbnails(
+                    photoTable.thumbnail_sources(import_id), thumbnail_dir, jobs
+                )
+            metrics.count(THUMBNAILS, "files", thumbnails)
+
+    metrics.report()
+
 
-def parse_date(timer_interval):
-    dt = datetime.datetime(2001, 1, 1) + datetime.timedelta(seconds=timer_interval)
+def parse_cli_date(value):
+    # Local date and optional time, e.g. 2010-01-31 or 2010-01-31T12:00, as a
+    # timestamp comparable with parse_date()'s.
+    try:
+        dt = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date %r" % value) from None
     return time.mktime(dt.timetuple())
 
 
@@ -442,7 +574,234 @@ if __name__ == "__main__":
         "--force-copy", dest="force_copy", action="store_true", help="Force image copy"
     )
 
+    parser.add_argument(
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of processes probing photos in parallel, "
+        "defaults to the number of CPUs",
+    )
+
+    parser.add_argument(
+        "--probe-cache",
+        dest="probe_cache",
+        default=None,
+        action="store",
+        help="file caching the md5, size and EXIF data of each image between "
+        "runs, defaults to the Shotwell DB path with a .probecache suffix",
+    )
+    parser.add_argument(
+        "--no-probe-cache",
+        dest="use_probe_cache",
+        action="store_false",
+        help="probe every image again, without reading or writing the cache",
+    )
+    parser.add_argument(
+        "--probe-cache-size",
+        dest="probe_cache_size",
+        type=int,
+        default=DEFAULT_MAX_ENTRIES,
+        help="maximum number of files kept in the probe cache",
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        dest="batch_size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="number of photos committed at once; an interrupted import "
+        "resumes after the last committed batch",
+    )
+
+    parser.add_argument(
+        "--fast-db",
+        dest="fast_db",
+        action="store_true",
+        help="relax the Shotwell DB's durability settings while importing; "
+        "if the import crashes, restore the DB from the backup",
+    )
+
+    parser.add_argument(
+        "--copy-jobs",
+        dest="copy_jobs",
+        type=int,
+        default=DEFAULT_COPY_JOBS,
+        help="number of threads linking or copying files in parallel",
+    )
+
+    parser.add_argument(
+        "--thumbnails",
+        dest="thumbnail_dir",
+        nargs="?",
+        const=DEFAULT_THUMBNAIL_DIR,
+        default=None,
+        help="generate Shotwell's thumbnails after the import, in THUMBNAIL_DIR "
+        "or %s by default" % DEFAULT_THUMBNAIL_DIR,
+    )
+
+    parser.add_argument(
+        "--rolls",
+        dest="rolls",
+        type=int,
+        nargs="+",
+        metavar="ROLL_ID",
+        help="only import the photos of these rolls (iPhoto events), by RollID",
+    )
+    parser.add_argument(
+        "--since",
+        dest="since",
+        type=parse_cli_date,
+        metavar="DATE",
+        help="only import the photos taken at or after DATE, e.g. 2010-01-31 or "
+        "2010-01-31T12:00",
+    )
+    parser.add_argument(
+        "--until",
+        dest="until",
+        type=parse_cli_date,
+        metavar="DATE",
+        help="only import the photos taken before DATE",
+    )
+    parser.add_argument(
+        "--path-prefix",
+        dest="path_prefixes",
+        action="append",
+        default=[],
+        metavar="PATH",
+        help="only import the photos whose original is below PATH, relative to "
+        "the iPhoto Library directory, e.g. Masters/2010; may be repeated",
+    )
+
+    parser.add_argument(
+        "--scan-jobs",
+        dest="scan_jobs",
+        type=int,
+        default=DEFAULT_SCAN_JOBS,
+        help="number of library directories listed at the same time "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--pipeline",
+        dest="pipelined",
+        action="store_true",
+        help="copy and insert the photos on their own threads while the next "
+        "ones are probed",
+    )
+    parser.add_argument(
+        "--no-backup",
+        dest="backup",
+        action="store_false",
+        help="don't copy the Shotwell DB before importing, the import can still "
+        "be undone with python -m iphoto_export.rollback",
+    )
+    parser.add_argument(
+        "--watch",
+        dest="watch",
+        action="store_true",
+        help="keep running and import what changed each time iPhoto rewrites "
+        "AlbumData.xml: new photos and photos edited or reverted since",
+    )
+    parser.add_argument(
+        "--watch-interval",
+        dest="watch_interval",
+        type=float,
+        default=DEFAULT_WATCH_INTERVAL,
+        help="seconds between two checks of AlbumData.xml (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--plan",
+        dest="plan",
+        nargs="?",
+        const="-",
+        default=None,
+        metavar="FILE",
+        help="don't import anything, write the plan of the import as JSON to FILE "
+        "or standard output: the rows to insert, files to link or copy, bytes, "
+        "skips, conflicts and an estimate of the time it takes; with --watch, "
+        "of the next sync",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        dest="metrics_json",
+        default=None,
+        help="write the time spent and files handled by each stage to this file",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        action="store_true",
+        help="log debug messages",
+    )
+
     args = parser.parse_args()
 
-    logging.basicConfig(level=logging.DEBUG)
-    import_photos(args.iphoto_dir, args.shotwell_db, args.photos_dir, args.force_copy)
+    probe_cache = None
+    if args.use_probe_cache:
+        probe_cache = args.probe_cache or "%s.probecache" % args.shotwell_db
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    def run(backup=args.backup, sync_state=None):
+        metrics = Metrics()
+        try:
+            import_photos(
+                args.iphoto_dir,
+                args.shotwell_db,
+                args.photos_dir,
+                args.force_copy,
+                args.jobs,
+                probe_cache,
+                args.probe_cache_size,
+                args.batch_size,
+                FAST_IMPORT_PRAGMAS if args.fast_db else (),
+                args.copy_jobs,
+                args.thumbnail_dir,
+                metrics,
+                args.pipelined,
+                args.scan_jobs,
+                backup,
+                Selection(args.rolls, args.since, args.until, args.path_prefixes),
+                sync_state,
+            )
+        finally:
+            if args.metrics_json:
+                metrics.write_json(args.metrics_json)
+
+    if args.plan:
+        # With --watch, the plan of the next sync.
+        plan = plan_import(
+            args.iphoto_dir,
+            args.shotwell_db,
+            args.photos_dir,
+            args.force_copy,
+            args.jobs,
+            probe_cache,
+            args.scan_jobs,
+            Selection(args.rolls, args.since, args.until, args.path_prefixes),
+            sync_state=SyncState(args.iphoto_dir) if args.watch else None,
+        )
+        log_plan(plan)
+        if args.plan == "-":
+            json.dump(plan, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        else:
+            with open(args.plan, "w") as f:
+                json.dump(plan, f, indent=2)
+    elif args.watch:
+        sync_state = SyncState(args.iphoto_dir)
+
+        def sync():
+            # The later syncs don't back the DB up again, each can be rolled
+            # back on its own.
+            run(args.backup and sync_state.digests is None, sync_state)
+
+        try:
+            watch(
+                join_path(args.iphoto_dir, "AlbumData.xml"), sync, args.watch_interval
+            )
+        except KeyboardInterrupt:
+            pass
+    else:
+        run()
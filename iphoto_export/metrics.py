@@ -0,0 +1,163 @@
+import collections
+import contextlib
+import json
+import logging
+import sys
+import threading
+import time
+
+_log = logging.getLogger("iphotoimport")
+
+# The stages of an import, in the order they are reported.
+SCAN = "scan"
+PLIST_PARSE = "plist parse"
+PROBE = "probe"
+EVENT_BUILD = "event build"
+DB_INSERT = "db insert"
+BACKUP = "backup"
+COPY = "copy"
+THUMBNAILS = "thumbnails"
+STAGES = (BACKUP, SCAN, PLIST_PARSE, PROBE, EVENT_BUILD, DB_INSERT, COPY, THUMBNAILS)
+
+
+class Metrics:
+    """Wall time and counters of each stage of an import.
+
+    Stages overlap (the plist is parsed while photos are probed, copies
+    happen between inserts...), so the time of a stage excludes the time of
+    any stage timed inside it and the stage times of a thread add up to the
+    total.  With the stages on several threads, see Pipeline, they add up
+    to more than that.
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.seconds = collections.Counter()
+        self.counters = collections.defaultdict(collections.Counter)
+        self.skips = collections.Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def _running(self):
+        # [stage, start] of the nested timers of the current thread.
+        if not hasattr(self._local, "running"):
+            self._local.running = []
+        return self._local.running
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        running = self._running
+        now = time.monotonic()
+        if running:
+            outer = running[-1]
+            self._add(outer[0], now - outer[1])
+        running.append([stage, now])
+        try:
+            yield
+        finally:
+            now = time.monotonic()
+            self._add(stage, now - running.pop()[1])
+            if running:
+                running[-1][1] = now
+
+    def _add(self, stage, seconds):
+        with self._lock:
+            self.seconds[stage] += seconds
+
+    def timed(self, stage, iterable):
+        # Yields from iterable, timing each step as stage.
+        iterator = iter(iterable)
+        while True:
+            with self.timer(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, stage, counter, n=1):
+        with self._lock:
+            self.counters[stage][counter] += n
+
+    def skip(self, reason, n=1):
+        with self._lock:
+            self.skips[reason] += n
+
+    def to_dict(self):
+        stages = {}
+        for stage in STAGES + tuple(s for s in self.seconds if s not in STAGES):
+            if stage in self.seconds or stage in self.counters:
+                stages[stage] = dict(self.counters[stage])
+                stages[stage]["seconds"] = round(self.seconds[stage], 3)
+        return {
+            "total_seconds": round(time.monotonic() - self.start, 3),
+            "stages": stages,
+            "skips": dict(self.skips),
+        }
+
+    def report(self):
+        for stage, values in self.to_dict()["stages"].items():
+            counters = ", ".join(
+                "%s %s" % (name, value)
+                for name, value in values.items()
+                if name != "seconds"
+            )
+            _log.info("%-12s %8.2fs %s", stage, values["seconds"], counters)
+        for reason, n in self.skips.items():
+            _log.info("skipped %s: %s", reason, n)
+
+    def write_json(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+class Progress:
+    """Progress line with rate and ETA.
+
+    The total amount of work isn't known up front when the library is
+    streamed, so the ETA is estimated from fraction(), e.g. the position in
+    AlbumData.xml.  On a terminal the line is redrawn in place, otherwise it
+    is logged every log_interval seconds.
+    """
+
+    def __init__(self, fraction, stream=sys.stderr, interval=0.5, log_interval=30):
+        self.fraction = fraction
+        self.stream = stream
+        self.tty = stream.isatty()
+        self.interval = interval if self.tty else log_interval
+        self.start = time.monotonic()
+        self.last = 0.0
+        self.done = 0
+
+    def update(self, n=1):
+        self.done += n
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.show(now)
+
+    def show(self, now):
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed else 0.0
+        fraction = self.fraction()
+        if fraction > 0:
+            eta = "%d:%02d" % divmod(int(elapsed * (1 - fraction) / fraction), 60)
+        else:
+            eta = "?"
+        line = "%d photos, %.1f/s, %3d%%, ETA %s" % (
+            self.done,
+            rate,
+            fraction * 100,
+            eta,
+        )
+        if self.tty:
+            self.stream.write("\r\033[K" + line)
+            self.stream.flush()
+        else:
+            _log.info(line)
+
+    def finish(self):
+        self.show(time.monotonic())
+        if self.tty:
+            self.stream.write("\n")
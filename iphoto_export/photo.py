@@ -0,0 +1,109 @@
+class Record:
+    """A probed file on its way to the Shotwell DB.
+
+    Values live in slots rather than in a dict per file.  Item access is
+    kept, so photo["orig_md5"] works as it did with dicts and dict(photo)
+    gives the named parameters of the INSERT statements.  Fields that
+    aren't set are None.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.pop(name, None))
+        if values:
+            raise TypeError(
+                "Unknown %s fields %s" % (type(self).__name__, ", ".join(values))
+            )
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def __setitem__(self, name, value):
+        try:
+            setattr(self, name, value)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def keys(self):
+        return self.__slots__
+
+    def __repr__(self):
+        return "%s(%s)" % (
+            type(self).__name__,
+            ", ".join("%s=%r" % (name, getattr(self, name)) for name in self.__slots__),
+        )
+
+
+class Photo(Record):
+    """A probed photo on its way to the PhotoTable and BackingPhotoTable."""
+
+    __slots__ = (
+        "id",
+        "event",
+        "event_id",
+        "import_id",
+        "editable_id",
+        "orig_image_path",
+        "mod_image_path",
+        "new_orig_path",
+        "new_mod_path",
+        "orig_file_size",
+        "mod_file_size",
+        "orig_timestamp",
+        "mod_timestamp",
+        "orig_exposure_time",
+        "mod_exposure_time",
+        "orig_md5",
+        "mod_md5",
+        "width",
+        "height",
+        "mod_width",
+        "mod_height",
+        "orientation",
+        "orig_orientation",
+        "orig_original_orientation",
+        "mod_orientation",
+        "mod_original_orientation",
+        "file_format",
+        "time_created",
+        "caption",
+        "comment",
+        "rating",
+    )
+
+
+class Video(Record):
+    """A probed movie on its way to the VideoTable.
+
+    Shotwell has no modified versions of movies, the original is imported
+    and a modified one is only copied.  Its fields are named like the ones
+    of Photo so both go through the same batches.
+    """
+
+    __slots__ = (
+        "id",
+        "event",
+        "event_id",
+        "import_id",
+        "orig_image_path",
+        "mod_image_path",
+        "new_orig_path",
+        "new_mod_path",
+        "orig_file_size",
+        "mod_file_size",
+        "orig_timestamp",
+        "orig_exposure_time",
+        "orig_md5",
+        "width",
+        "height",
+        "clip_duration",
+        "time_created",
+        "caption",
+        "comment",
+        "rating",
+    )
@@ -0,0 +1,115 @@
+import collections
+import queue
+import threading
+
+# Number of items waiting in front of each stage.
+DEFAULT_DEPTH = 2
+
+# Number of items handed to each worker of a pool before results are
+# collected, see map_bounded().  Keeps the workers busy while bounding the
+# number of items in flight.
+QUEUE_DEPTH_PER_JOB = 4
+
+_DONE = object()
+
+
+class Pipeline:
+    """Runs items through a chain of stages, each stage on its own thread.
+
+    A stage is a function taking an item and returning the item for the next
+    stage.  The stages are connected by queues holding at most depth items,
+    so a stage that falls behind blocks the ones feeding it rather than
+    letting the work pile up in memory.  An error in a stage is raised by
+    the next put() or by close().
+
+    With threaded=False the stages run in the caller's thread on put().
+    """
+
+    def __init__(self, stages, depth=DEFAULT_DEPTH, threaded=True):
+        self.stages = stages
+        self.threaded = threaded
+        self.error = None
+        self.cancelled = False
+        self.queues = []
+        self.threads = []
+        if threaded:
+            self.queues = [queue.Queue(depth) for stage in stages]
+            for i, stage in enumerate(stages):
+                thread = threading.Thread(
+                    target=self._run,
+                    args=(i,),
+                    name="pipeline-%s" % getattr(stage, "__name__", i),
+                    daemon=True,
+                )
+                thread.start()
+                self.threads.append(thread)
+
+    def _run(self, i):
+        inbox = self.queues[i]
+        outbox = self.queues[i + 1] if i + 1 < len(self.queues) else None
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                break
+            # After an error the remaining items are drained without being
+            # processed so the stages feeding this one never block.
+            if self.error is not None or self.cancelled:
+                continue
+            try:
+                item = self.stages[i](item)
+            except BaseException as e:
+                self.error = e
+                continue
+            if outbox is not None:
+                outbox.put(item)
+        if outbox is not None:
+            outbox.put(_DONE)
+
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+        if not self.threaded:
+            for stage in self.stages:
+                item = stage(item)
+            return
+        self.queues[0].put(item)
+
+    def close(self):
+        # Waits for the items in flight to go through all the stages.
+        self._join()
+        if self.error is not None:
+            raise self.error
+
+    def _join(self):
+        if self.threads:
+            self.queues[0].put(_DONE)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Whatever is still in flight is dropped.
+            self.cancelled = True
+            self._join()
+
+
+def map_bounded(executor, fn, items, jobs):
+    """Like executor.map(fn, items), yielding the results in order.
+
+    Items are submitted while earlier results are collected, at most jobs *
+    QUEUE_DEPTH_PER_JOB at a time, so a lazily produced stream of items is
+    never fully buffered.
+    """
+    in_flight = collections.deque()
+    for item in items:
+        in_flight.append(executor.submit(fn, item))
+        if len(in_flight) >= jobs * QUEUE_DEPTH_PER_JOB:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
@@ -0,0 +1,414 @@
+import collections
+import hashlib
+import logging
+import mimetypes
+import os
+import random
+import sqlite3
+import sys
+import time
+from os.path import join as join_path
+
+from iphoto_export.album_data import (
+    ARCHIVE_PATH,
+    PHOTO,
+    ROLL,
+    AlbumDataError,
+    ArchivePaths,
+    KeySet,
+    Selection,
+    entry_skip,
+    located_photos,
+    parse_date,
+    read_album_data,
+)
+from iphoto_export.cache import ProbeCache, connect_readonly
+from iphoto_export.fs import FileSystem
+from iphoto_export.probe import (
+    FILE_FORMAT,
+    SKIP_MISSING,
+    SKIP_NO_EVENT,
+    SKIP_NOT_IMAGE,
+    photo_task,
+    task_files,
+)
+from iphoto_export.scan import DEFAULT_SCAN_JOBS, StatIndex
+from iphoto_export.video import VIDEO_MIMES
+
+_log = logging.getLogger("iphotoimport")
+
+# What the import does with a file, see plan_import().
+LINK = "link"
+COPY = "copy"
+EXISTS = "exists"  # The destination is the source already, a hard link.
+COMPARE = "compare"  # The destination exists, it's compared with the source.
+
+# Bounds of the read throughput measurement, so a plan takes seconds.
+MEASURE_BYTES = 64 * 2**20
+MEASURE_SECONDS = 2.0
+MEASURE_FILES = 16
+# Bytes hashed to measure the md5 throughput of a CPU.
+MEASURE_MD5_BYTES = 32 * 2**20
+
+
+def plan_import(
+    iphoto_dir,
+    shotwell_db,
+    photos_dir,
+    force_copy,
+    jobs=1,
+    probe_cache=None,
+    scan_jobs=DEFAULT_SCAN_JOBS,
+    selection=None,
+    measure=True,
+    sync_state=None,
+):
+    """Work out what import_photos() would do, without doing it.
+
+    The library file is parsed, the library's files and their destinations
+    are stat'ed and the Shotwell DB and the probe cache are read; nothing is
+    hashed, decoded or written.  Returns the plan as a dict: the rows to
+    insert, the expected skips, the destinations that would clash, what
+    happens to each file, the bytes to hash and copy and an estimate of the
+    import's runtime from the measured read and md5 throughputs.  With a
+    sync_state it's the plan of the next sync of --watch.
+    """
+    start = time.monotonic()
+    if selection is None:
+        selection = Selection()
+    album_data_filename = join_path(iphoto_dir, "AlbumData.xml")
+    for filename in (album_data_filename, shotwell_db):
+        if not os.path.exists(filename):
+            _log.error("%s not found", filename)
+            sys.exit(1)
+    fs = FileSystem(force_copy)
+    db = connect_readonly(shotwell_db)
+    try:
+        imported_photos = _column(db, "PhotoTable", "filename")
+        imported_photos |= _column(db, "VideoTable", "filename")
+        imported_backing_photos = _column(db, "BackingPhotoTable", "filepath")
+        imported_events = {
+            (name, time_created)
+            for name, time_created in db.execute(
+                "SELECT name, time_created FROM EventTable"
+            )
+        }
+        if sync_state is not None:
+            try:
+                sync_state.begin(db)
+            except sqlite3.OperationalError:
+                # The library was never synced, the table isn't there.
+                sync_state.digests = {}
+                sync_state.pending = {}
+    finally:
+        db.close()
+    cache = None
+    if probe_cache and os.path.exists(probe_cache):
+        cache = ProbeCache(probe_cache, readonly=True)
+
+    # See import_photos().
+    if sync_state is not None and sync_state.warm:
+        stat_index = StatIndex()
+    else:
+        stat_index = StatIndex.for_library(iphoto_dir, scan_jobs, selection)
+
+    skips = collections.Counter()
+    conflicts = []
+    actions = []
+    rolls = {}
+    # (key, roll id, "photos", "videos" or "updated", new backing photo or
+    # None) of the entries to insert or update.
+    planned = []
+    # Keys of the entries edited or reverted since the last sync.
+    changed_keys = set()
+    # new_orig_path and new_mod_path -> key, to find clashes.
+    destinations = {}
+    backing_destinations = {}
+    destination_devs = {}  # st_dev -> Counter of the actions and bytes.
+    probed_files = 0
+    hash_bytes = 0
+    copy_bytes = 0
+    # Bytes read besides the hashing: copies of cached files and existing
+    # destinations.
+    reread_bytes = 0
+    paths = None
+
+    def plan_file(src, dst, st, probed):
+        # Records what happens to src and returns whether it gets hashed.
+        nonlocal hash_bytes, copy_bytes, reread_bytes
+        # See FileSystem.safe_link_file().
+        try:
+            dst_st = None if force_copy else os.stat(dst)
+        except FileNotFoundError:
+            dst_st = None
+        if dst_st is not None:
+            if (dst_st.st_dev, dst_st.st_ino) == (st.st_dev, st.st_ino):
+                action = EXISTS
+            else:
+                # The import fails on a file of another size, other files are
+                # read again to be compared.
+                action = COMPARE
+                reread_bytes += dst_st.st_size
+                if dst_st.st_size != st.st_size:
+                    conflicts.append(
+                        {
+                            "conflict": "destination file differs",
+                            "path": dst,
+                            "source": src,
+                        }
+                    )
+        elif force_copy or st.st_dev != fs.dir_dev(os.path.dirname(dst)):
+            action = COPY
+        else:
+            action = LINK
+        cached = probed and cache is not None and cache.get(src, st) is not None
+        if probed and not cached:
+            hash_bytes += st.st_size
+        if action == COPY:
+            copy_bytes += st.st_size
+            if not probed or cached:
+                reread_bytes += st.st_size
+        dev = destination_devs.setdefault(
+            fs.dir_dev(os.path.dirname(dst)), collections.Counter()
+        )
+        dev[action] += 1
+        if action == COPY:
+            dev["copy bytes"] += st.st_size
+        actions.append({"src": src, "dst": dst, "action": action, "bytes": st.st_size})
+        return probed and not cached
+
+    def conflict(seen, constraint, path, key):
+        # Two entries inserting the same path fail the import.
+        if path in seen:
+            conflicts.append(
+                {"conflict": constraint, "path": path, "keys": [seen[path], key]}
+            )
+        seen[path] = key
+
+    def plan_photo(key, i_photo):
+        nonlocal probed_files
+        reason = entry_skip(
+            key,
+            i_photo,
+            paths,
+            selection,
+            imported_photos,
+            sync_state,
+            changed_keys,
+        )
+        if reason is not None:
+            skips[reason] += 1
+            return
+        task = photo_task(key, i_photo, paths, stat_index)
+        stats = task[-1]
+        mod, orig, new_mod, new_orig = task_files(task)
+        mod_st = stats[mod] if mod else None
+        orig_st = stats[orig]
+        if orig_st is None:
+            skips[SKIP_MISSING] += 1
+            return
+        mime, _ = mimetypes.guess_type(orig)
+        if mime in VIDEO_MIMES:
+            kind = "videos"
+        elif mime in FILE_FORMAT:
+            kind = "photos"
+        else:
+            # Not probed, but still copied.
+            skips[SKIP_NOT_IMAGE] += 1
+            plan_file(orig, new_orig, orig_st, False)
+            if mod:
+                plan_file(mod, new_mod, mod_st, False)
+            return
+        probed_files += plan_file(orig, new_orig, orig_st, True)
+        backing_photo = None
+        if mod:
+            probed_files += plan_file(mod, new_mod, mod_st, kind == "photos")
+            if kind == "photos" and new_mod not in imported_backing_photos:
+                backing_photo = new_mod
+        if key in changed_keys and new_orig in imported_photos:
+            # Only the modified version of an imported photo is updated, see
+            # import_photos().
+            if kind == "photos":
+                planned.append((key, None, "updated", backing_photo))
+            return
+        table = "VideoTable" if kind == "videos" else "PhotoTable"
+        conflict(destinations, "UNIQUE %s.filename" % table, new_orig, key)
+        if backing_photo:
+            conflict(
+                backing_destinations, "UNIQUE BackingPhotoTable.filepath", new_mod, key
+            )
+        planned.append((key, i_photo.get("Roll"), kind, backing_photo))
+
+    try:
+        with open(album_data_filename, "rb") as album_data:
+            for kind, key, value in located_photos(read_album_data(album_data)):
+                if kind == PHOTO:
+                    plan_photo(key, value)
+                elif kind == ROLL:
+                    if selection.roll(value):
+                        rolls[value["RollID"]] = (
+                            KeySet(value["KeyList"]),
+                            value["RollName"],
+                            int(parse_date(value["RollDateAsTimerInterval"])),
+                        )
+                elif key == ARCHIVE_PATH:
+                    paths = ArchivePaths(value, iphoto_dir, photos_dir)
+    except AlbumDataError as e:
+        _log.error("%s", e)
+        sys.exit(4)
+    finally:
+        if cache:
+            cache.close()
+
+    # Only the rolls that get photos become events.
+    counts = collections.Counter()
+    new_events = set()
+    new_backing_photos = set()
+    for key, roll_id, kind, backing_photo in planned:
+        # Updated photos keep their event.
+        if kind != "updated":
+            roll = rolls.get(roll_id)
+            if roll is None or key not in roll[0]:
+                skips[SKIP_NO_EVENT] += 1
+                continue
+            if (roll[1], roll[2]) not in imported_events:
+                new_events.add(roll_id)
+        if backing_photo:
+            new_backing_photos.add(backing_photo)
+        counts[kind] += 1
+
+    plan = {
+        "photos": counts["photos"],
+        "videos": counts["videos"],
+        "updated_photos": counts["updated"],
+        "events": len(new_events),
+        "backing_photos": len(new_backing_photos),
+        "skips": dict(skips),
+        "conflicts": conflicts,
+        "destinations": {
+            str(dev): dict(values) for dev, values in destination_devs.items()
+        },
+        "bytes": {
+            "hash": hash_bytes,
+            "hash_files": probed_files,
+            "copy": copy_bytes,
+            "total": sum(action["bytes"] for action in actions),
+        },
+    }
+    if measure:
+        read_rate = measure_read_throughput(
+            [action["src"] for action in actions if action["action"] != EXISTS]
+        )
+        md5_rate = measure_md5_throughput()
+        plan["throughput"] = {"read": read_rate, "md5": md5_rate}
+        plan["estimated_seconds"] = estimate_seconds(
+            hash_bytes, copy_bytes, reread_bytes, read_rate, md5_rate, jobs
+        )
+    plan["plan_seconds"] = round(time.monotonic() - start, 3)
+    plan["files"] = actions
+    return plan
+
+
+def _column(db, table, column):
+    cursor = db.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type='table' AND name=?", (table,)
+    )
+    if not cursor.fetchone()[0]:
+        return set()
+    return {row[0] for row in db.execute("SELECT %s FROM %s" % (column, table))}
+
+
+def measure_read_throughput(paths):
+    # Bytes per second read from a random sample of paths.  The pages of
+    # the files are dropped from the page cache first where the OS allows
+    # it, so the disk is measured rather than memory.
+    paths = random.sample(paths, min(len(paths), MEASURE_FILES))
+    read = 0
+    start = time.monotonic()
+    for path in paths:
+        try:
+            with open(path, "rb", buffering=0) as f:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                while read < MEASURE_BYTES:
+                    data = f.read(2**20)
+                    if not data:
+                        break
+                    read += len(data)
+        except OSError as e:
+            _log.warning("Failed to read %s: %s", path, e)
+        if read >= MEASURE_BYTES or time.monotonic() - start >= MEASURE_SECONDS:
+            break
+    elapsed = time.monotonic() - start
+    return int(read / elapsed) if read and elapsed else None
+
+
+def measure_md5_throughput():
+    # Bytes per second one CPU hashes.
+    data = bytes(2**20)
+    md5 = hashlib.md5()
+    start = time.monotonic()
+    for _ in range(MEASURE_MD5_BYTES // len(data)):
+        md5.update(data)
+    return int(MEASURE_MD5_BYTES / (time.monotonic() - start))
+
+
+def estimate_seconds(hash_bytes, copy_bytes, reread_bytes, read_rate, md5_rate, jobs):
+    """Estimate the runtime of an import from its bytes and throughputs.
+
+    The files that aren't in the probe cache are read once, hashed and, if
+    they can't be linked, copied at the same time.  Reading is bound by the
+    disk and hashing by the CPUs, whichever is slower.  Copies of cached
+    files read them again.  Writes aren't measured, a plan writes nothing,
+    so they're assumed to go as fast as reads.  Returns None for the parts
+    whose throughput is unknown.
+    """
+    if not read_rate:
+        return None
+    read = (hash_bytes + reread_bytes) / read_rate
+    hashing = hash_bytes / (md5_rate * max(jobs, 1))
+    write = copy_bytes / read_rate
+    return {
+        "read": round(read, 1),
+        "hash": round(hashing, 1),
+        "write": round(write, 1),
+        "total": round(max(read, hashing) + write, 1),
+    }
+
+
+def log_plan(plan):
+    _log.info(
+        "Would insert %s photos, %s videos, %s backing photos and %s events",
+        plan["photos"],
+        plan["videos"],
+        plan["backing_photos"],
+        plan["events"],
+    )
+    if plan["updated_photos"]:
+        _log.info(
+            "Would update the modified version of %s photos", plan["updated_photos"]
+        )
+    for reason, n in sorted(plan["skips"].items()):
+        _log.info("Would skip %s: %s", reason, n)
+    for dev, values in plan["destinations"].items():
+        _log.info(
+            "Destination device %s: %s",
+            dev,
+            ", ".join("%s %s" % item for item in sorted(values.items())),
+        )
+    _log.info(
+        "%.1f MB to hash, %.1f MB to copy, %.1f MB in all",
+        plan["bytes"]["hash"] / 2**20,
+        plan["bytes"]["copy"] / 2**20,
+        plan["bytes"]["total"] / 2**20,
+    )
+    for conflict in plan["conflicts"]:
+        _log.warning("Conflict: %s", conflict)
+    estimate = plan.get("estimated_seconds")
+    if estimate:
+        _log.info(
+            "Estimated import time %d:%02d (read %.0f MB/s, md5 %.0f MB/s per CPU)",
+            *divmod(int(estimate["total"]), 60),
+            plan["throughput"]["read"] / 2**20,
+            plan["throughput"]["md5"] / 2**20,
+        )
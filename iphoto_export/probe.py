@@ -0,0 +1,483 @@
+import datetime
+import io
+import logging
+import mimetypes
+import multiprocessing
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image  # @UnresolvedImport
+
+from iphoto_export.album_data import parse_date
+from iphoto_export.cache import ProbeCache
+from iphoto_export.fs import Copy
+from iphoto_export.header import read_header
+from iphoto_export.photo import Photo, Video
+from iphoto_export.pipeline import map_bounded
+from iphoto_export.video import VIDEO_MIMES, read_video_header
+
+_log = logging.getLogger("iphotoimport")
+
+FILE_FORMAT = {
+    "image/jpeg": 0,
+    # Raw = 1
+    "image/png": 2,
+    "image/tiff": 3,
+    # Older Pythons guess BMPs as image/x-ms-bmp.
+    "image/bmp": 4,
+    "image/x-ms-bmp": 4,
+}
+
+# Reasons for skipping a photo.
+SKIP_MISSING = "missing"
+SKIP_NOT_IMAGE = "not an image"
+SKIP_METADATA = "unreadable metadata"
+# The photo's roll isn't in the library, see import_photos().
+SKIP_NO_EVENT = "no event"
+
+# Keys of the Master Image List entries used by PhotoProber, the rest of an
+# entry isn't sent to the workers.
+ALBUM_DATA_KEYS = ("Caption", "Comment", "Rating", "Roll", "DateAsTimerInterval")
+
+
+def photo_task(key, i_photo, paths, stat_index):
+    # The task of PhotoProber for an entry of the Master Image List, paths
+    # is the library's ArchivePaths.
+    mod_image_path = paths.source(i_photo.get("ImagePath"))
+    orig_image_path = paths.source(i_photo.get("OriginalPath"))
+    stats = {
+        path: stat_index.stat(path)
+        for path in (mod_image_path, orig_image_path)
+        if path
+    }
+    return (
+        key,
+        {k: i_photo[k] for k in ALBUM_DATA_KEYS if k in i_photo},
+        mod_image_path,
+        orig_image_path,
+        paths.destination(i_photo.get("ImagePath")),
+        paths.destination(i_photo.get("OriginalPath")),
+        stats,
+    )
+
+
+def task_files(task):
+    # The mod_image_path, orig_image_path, new_mod_path and new_orig_path a
+    # task is imported from.  An entry without an original or whose modified
+    # version is missing is imported from its one file, as the original.
+    _, _, mod_image_path, orig_image_path, new_mod_path, new_orig_path, stats = task
+    if not orig_image_path or stats[mod_image_path] is None:
+        return None, mod_image_path, None, new_mod_path
+    return mod_image_path, orig_image_path, new_mod_path, new_orig_path
+
+
+def exif_datetime_to_time(dt):
+    if isinstance(dt, str):
+        # Looks like the exif lib couldn't parse the date.  I've seen dates
+        # like 2007:00:00 00:00:00.  Let's try that.
+        match = re.match(r"(\d{4}):(\d\d):(\d\d) (\d\d):(\d\d):(\d\d)", dt)
+        if match:
+            y, m, d, h, mn, s = [int(x) for x in match.groups()]
+            m += 1  # datetime uses 1-indexed months/days
+            assert m <= 12
+            d += 1
+            assert d <= 31
+            dt = datetime.datetime(y, m, d, h, mn, s)
+        else:
+            raise Exception("Failed to parse date %s" % dt)
+
+    return int(time.mktime(dt.timetuple()))
+
+
+def image_size(path, head):
+    # The size is in the header, so the first block of the file is usually
+    # enough.  TIFF may keep its first IFD anywhere in the file though.
+    try:
+        return Image.open(io.BytesIO(head)).size
+    except Exception:
+        return Image.open(path).size
+
+
+def metadata_buffer(head, mime, file_size):
+    # JPEG keeps EXIF in an APP1 segment near the start of the file, other
+    # formats can only be parsed from a buffer if it holds the whole file.
+    if head is not None and (mime == "image/jpeg" or len(head) >= file_size):
+        return head
+    return None
+
+
+def read_metadata(path, photo, prefix="orig_", buffer=None):
+    # Only needed for the files read_header() can't handle, and loading the
+    # exiv2 bindings is slow, so they are imported on first use.
+    from pyexiv2.metadata import ImageMetadata
+
+    photo[prefix + "orientation"] = 1
+    photo[prefix + "original_orientation"] = 1
+    try:
+        if buffer is not None:
+            meta = ImageMetadata.from_buffer(buffer)
+        else:
+            meta = ImageMetadata(path)
+        meta.read()
+        try:
+            photo[prefix + "orientation"] = meta["Exif.Image.Orientation"].value
+            photo[prefix + "original_orientation"] = meta[
+                "Exif.Image.Orientation"
+            ].value
+        except KeyError:
+            _log.debug("Failed to read the orientation from %s" % path)
+        exposure_dt = meta["Exif.Image.DateTime"].value
+        photo[prefix + "exposure_time"] = exif_datetime_to_time(exposure_dt)
+    except KeyError:
+        pass
+    except Exception:
+        _log.exception("Failed to read date from %s", path)
+        raise
+
+
+class MetadataError(Exception):
+    pass
+
+
+class PhotoProber:
+    """Turns a Master Image List entry into a photo record.
+
+    Instances are handed to worker processes, so they only hold picklable
+    state.  A task is a tuple of (key, i_photo, mod_image_path,
+    orig_image_path, new_mod_path, new_orig_path, stats), stats mapping the
+    source paths to their FileStat or None if they don't exist, see
+    StatIndex.  The result is a tuple of (key, photo, copies, skipped,
+    probes, used) where photo is a Photo or a Video, or None and skipped is
+    a (reason, path) pair if the entry was skipped, copies lists the Copy
+    entries to link or copy and probes maps each freshly probed path to its
+    (stat, probe) pair so the caller can store it in the probe cache.  used
+    is the (hits, stale) pair of the paths found in the probe cache, for the
+    caller to touch or drop, see ProbeCache.take_used().
+    """
+
+    def __init__(self, fs, schema_version, now, cache_filename=None):
+        self.fs = fs
+        self.schema_version = schema_version
+        self.now = now
+        self.cache_filename = cache_filename
+        self._cache = None
+        # Probes of the files with several hard links, by (st_dev, st_ino),
+        # so each is only hashed once whatever path it's found through.
+        self._inodes = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_cache"] = None
+        state["_inodes"] = {}
+        return state
+
+    @property
+    def cache(self):
+        # Each process reads the cache through its own connection, only the
+        # importer writes to it.
+        if self._cache is None and self.cache_filename:
+            self._cache = ProbeCache(self.cache_filename, readonly=True)
+        return self._cache
+
+    def __call__(self, task):
+        result = self.probe_task(task)
+        used = self.cache.take_used() if self.cache else ((), ())
+        return result + (used,)
+
+    def probe_task(self, task):
+        (
+            key,
+            i_photo,
+            mod_image_path,
+            orig_image_path,
+            new_mod_path,
+            new_orig_path,
+            stats,
+        ) = task
+        copies = []
+        probes = {}
+
+        mod_image_path, orig_image_path, new_mod_path, new_orig_path = task_files(task)
+        mod_file_size = stats[mod_image_path].st_size if mod_image_path else None
+
+        if stats[orig_image_path] is None:
+            _log.error("Original file not found %s", orig_image_path)
+            return key, None, copies, (SKIP_MISSING, orig_image_path), probes
+
+        mime, _ = mimetypes.guess_type(orig_image_path)
+
+        if mime in VIDEO_MIMES:
+            return self.probe_video(
+                key,
+                i_photo,
+                mod_image_path,
+                orig_image_path,
+                new_mod_path,
+                new_orig_path,
+                stats,
+                mime,
+            )
+
+        if mime not in FILE_FORMAT:
+            _log.error(
+                "Skipping %s, it's not an image, it's a %s", orig_image_path, mime
+            )
+            copies.append(Copy(orig_image_path, new_orig_path))
+            if mod_image_path:
+                copies.append(Copy(mod_image_path, new_mod_path))
+            return key, None, copies, (SKIP_NOT_IMAGE, orig_image_path), probes
+
+        caption = i_photo.get("Caption", "")
+
+        try:
+            orig = self.probe_file(
+                orig_image_path,
+                new_orig_path,
+                stats[orig_image_path],
+                mime,
+                copies,
+                probes,
+            )
+            mod = None
+            if mod_image_path:
+                # A modified version the size of the original may well be the
+                # same bytes, it's hashed first so it can be linked to the
+                # original's copy rather than be copied again.
+                fuse = mod_file_size != stats[orig_image_path].st_size
+                try:
+                    mod = self.probe_file(
+                        mod_image_path,
+                        new_mod_path,
+                        stats[mod_image_path],
+                        mime,
+                        copies,
+                        probes,
+                        fuse,
+                    )
+                except MetadataError:
+                    raise
+                except Exception:
+                    _log.error(
+                        "Failed to open modified image %s, skipping", mod_image_path
+                    )
+                    orig_image_path = mod_image_path
+                    new_orig_path = new_mod_path
+                    new_mod_path = None
+                    mod_image_path = None
+                    mod_file_size = None
+        except MetadataError:
+            _log.error("**** Skipping %s" % orig_image_path)
+            return key, None, copies, (SKIP_METADATA, orig_image_path), probes
+
+        file_format = FILE_FORMAT.get(mime, -1)
+        if file_format == -1:
+            raise Exception("Unknown image type %s" % mime)
+
+        photo = Photo(
+            orig_image_path=orig_image_path,
+            mod_image_path=mod_image_path,
+            new_mod_path=new_mod_path,
+            new_orig_path=new_orig_path,
+            orig_file_size=stats[orig_image_path].st_size,
+            mod_file_size=mod_file_size,
+            mod_timestamp=mod and mod["timestamp"],
+            orig_timestamp=orig["timestamp"],
+            caption=caption,
+            rating=i_photo["Rating"],
+            event=i_photo["Roll"],
+            orig_exposure_time=int(parse_date(i_photo["DateAsTimerInterval"])),
+            width=orig["width"],
+            height=orig["height"],
+            mod_width=mod and mod["width"],
+            mod_height=mod and mod["height"],
+            orig_md5=orig["md5"],
+            mod_md5=mod and mod["md5"],
+            file_format=file_format,
+            time_created=self.now,
+            import_id=self.now,
+        )
+
+        # May be it's available in previous versions
+        if self.schema_version >= 20:
+            photo["comment"] = i_photo["Comment"]
+
+        for prefix, info in (("orig_", orig), ("mod_", mod)):
+            if info is None:
+                continue
+            photo[prefix + "orientation"] = info["orientation"]
+            photo[prefix + "original_orientation"] = info["orientation"]
+            if info["exposure_time"] is not None:
+                photo[prefix + "exposure_time"] = info["exposure_time"]
+            photo["orientation"] = info["orientation"]
+
+        return key, photo, copies, None, probes
+
+    def probe_video(
+        self,
+        key,
+        i_photo,
+        mod_image_path,
+        orig_image_path,
+        new_mod_path,
+        new_orig_path,
+        stats,
+        mime,
+    ):
+        copies = []
+        probes = {}
+        try:
+            orig = self.probe_file(
+                orig_image_path,
+                new_orig_path,
+                stats[orig_image_path],
+                mime,
+                copies,
+                probes,
+            )
+        except MetadataError:
+            _log.error("**** Skipping %s" % orig_image_path)
+            return key, None, copies, (SKIP_METADATA, orig_image_path), probes
+        mod_file_size = None
+        if mod_image_path:
+            # Shotwell can't keep a modified version of a movie, it's only
+            # copied along.
+            mod_file_size = stats[mod_image_path].st_size
+            copies.append(Copy(mod_image_path, new_mod_path))
+
+        video = Video(
+            orig_image_path=orig_image_path,
+            mod_image_path=mod_image_path,
+            new_mod_path=new_mod_path,
+            new_orig_path=new_orig_path,
+            orig_file_size=stats[orig_image_path].st_size,
+            mod_file_size=mod_file_size,
+            orig_timestamp=orig["timestamp"],
+            caption=i_photo.get("Caption", ""),
+            rating=i_photo["Rating"],
+            event=i_photo["Roll"],
+            orig_exposure_time=int(parse_date(i_photo["DateAsTimerInterval"])),
+            width=orig["width"],
+            height=orig["height"],
+            clip_duration=orig["clip_duration"],
+            orig_md5=orig["md5"],
+            time_created=self.now,
+            import_id=self.now,
+        )
+        if self.schema_version >= 20:
+            video["comment"] = i_photo["Comment"]
+        if orig["exposure_time"] is not None:
+            video["orig_exposure_time"] = orig["exposure_time"]
+        return key, video, copies, None, probes
+
+    def probe_file(self, path, dst, st, mime, copies, probes, fuse=True):
+        # Returns the md5, size, orientation and EXIF date of path, or the
+        # duration and creation time of a movie, from the probe cache if the
+        # file hasn't changed since it was last probed.
+        info = self.known_inode(st)
+        if info is None and self.cache:
+            info = self.cache.get(path, st)
+        if info is not None:
+            copies.append(Copy(path, dst, info["md5"], st.st_size))
+        else:
+            md5, head = self.read_file(path, dst, st, copies, fuse)
+            info = {"md5": md5, "mime": mime, "exposure_time": None}
+            if mime in VIDEO_MIMES:
+                self.read_video_info(path, info)
+            else:
+                self.read_image_info(path, head, mime, st, info)
+            probes[path] = (st, info)
+        if st.st_nlink > 1:
+            self._inodes[st.st_dev, st.st_ino] = (st.st_size, st.st_mtime_ns, info)
+        info = dict(info, timestamp=int(st.st_mtime))
+        return info
+
+    def read_image_info(self, path, head, mime, st, info):
+        header = read_header(head, mime)
+        if header is not None:
+            info["width"] = header["width"]
+            info["height"] = header["height"]
+            info["orientation"] = header["orientation"]
+            if header["datetime"] is not None:
+                try:
+                    info["exposure_time"] = exif_datetime_to_time(header["datetime"])
+                except Exception as e:
+                    _log.exception("Failed to read date from %s", path)
+                    raise MetadataError(path) from e
+        else:
+            # Decode the files whose headers are exotic or don't fit in the
+            # first block.
+            info["width"], info["height"] = image_size(path, head)
+            try:
+                read_metadata(path, info, "", metadata_buffer(head, mime, st.st_size))
+            except Exception as e:
+                raise MetadataError(path) from e
+
+    def read_video_info(self, path, info):
+        # Only the atoms describing the movie are read, not its media.
+        header = read_video_header(path)
+        if header is None:
+            _log.error("Failed to read the movie header of %s", path)
+            raise MetadataError(path)
+        info["width"] = header["width"]
+        info["height"] = header["height"]
+        info["clip_duration"] = header["duration"]
+        info["exposure_time"] = header["creation_time"]
+
+    def known_inode(self, st):
+        known = self._inodes.get((st.st_dev, st.st_ino))
+        if known is None or known[:2] != (st.st_size, st.st_mtime_ns):
+            return None
+        return known[2]
+
+    def read_file(self, src, dst, st, copies, fuse=True):
+        # Copies that can't be done with a hard link are fused with hashing,
+        # the rest are left to the copy queue.
+        if fuse and self.fs.needs_copy(src, dst, st.st_dev):
+            start = time.monotonic()
+            md5, head = self.fs.read_file(src, dst)
+            seconds = time.monotonic() - start
+            copies.append(Copy(src, dst, md5, st.st_size, True, seconds))
+        else:
+            md5, head = self.fs.read_file(src)
+            copies.append(Copy(src, dst, md5, st.st_size))
+        return md5, head
+
+
+def probe_photos(prober, tasks, jobs=1):
+    """Run prober over tasks, yielding the results in task order.
+
+    With more than one job the probes run on a process pool while tasks are
+    still being produced; only a bounded number of tasks is in flight at
+    any time so a lazily produced task stream is never fully buffered.
+    """
+    if jobs <= 1:
+        for task in tasks:
+            yield prober(task)
+        return
+
+    # The importer's backup and pipeline threads are running by now, a forked
+    # worker could inherit a lock one of them holds, e.g. sqlite's or
+    # logging's, and hang.  Workers are started from a clean server process.
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=_init_worker,
+        initargs=(prober,),
+    ) as executor:
+        yield from map_bounded(executor, _probe, tasks, jobs)
+
+
+# The prober of a worker process.  It's sent once when the worker starts
+# rather than with each task so its cache connection and inode index live as
+# long as the worker.
+_worker_prober = None
+
+
+def _init_worker(prober):
+    global _worker_prober
+    _worker_prober = prober
+
+
+def _probe(task):
+    return _worker_prober(task)
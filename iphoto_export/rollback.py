@@ -0,0 +1,150 @@
+import argparse
+import glob
+import logging
+import os.path
+import sqlite3
+import sys
+import time
+
+from iphoto_export.database import (
+    ImportTable,
+    backup_filename,
+    copy_database,
+    rollback_import,
+)
+
+_log = logging.getLogger("iphotoimport")
+
+
+def list_imports(shotwell_db):
+    db = sqlite3.connect(shotwell_db)
+    try:
+        imports = ImportTable(db).imports()
+    finally:
+        db.close()
+    for import_id, iphoto_dir, started, checkpoint, photos, finished in imports:
+        backup = backup_filename(shotwell_db, import_id)
+        print(
+            "%s  %s  %6s photos  %-11s  %s%s"
+            % (
+                import_id,
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(started)),
+                photos,
+                "finished" if finished else "interrupted",
+                iphoto_dir,
+                "  (backup %s)" % backup if os.path.exists(backup) else "",
+            )
+        )
+
+
+def undo_import(shotwell_db, import_id):
+    # Deletes the rows of the import, leaving whatever happened since alone.
+    db = sqlite3.connect(shotwell_db)
+    try:
+        with db:
+            photos, videos, backing_photos, events, restored = rollback_import(
+                db, import_id
+            )
+    finally:
+        db.close()
+    _log.info(
+        "Deleted %s photos, %s videos, %s backing photos and %s events of import %s",
+        photos,
+        videos,
+        backing_photos,
+        events,
+        import_id,
+    )
+    if restored:
+        _log.info("Restored the previous modified version of %s photos", restored)
+
+
+def restore_backup(shotwell_db, import_id):
+    # Puts the whole DB back as it was when the import started, dropping
+    # whatever happened since.
+    backup = backup_filename(shotwell_db, import_id)
+    if not os.path.exists(backup):
+        _log.error("No backup of import %s at %s", import_id, backup)
+        sys.exit(1)
+    copy_database(backup, shotwell_db)
+    _log.info("Restored %s from %s", shotwell_db, backup)
+
+
+def prune_backups(shotwell_db, keep):
+    # Deletes the backups of all but the keep most recent imports, and those
+    # of imports that have been rolled back.
+    db = sqlite3.connect(shotwell_db)
+    try:
+        import_ids = {row[0] for row in ImportTable(db).imports()}
+    finally:
+        db.close()
+    backups = {}
+    for backup in glob.glob(glob.escape(backup_filename(shotwell_db, "")) + "*"):
+        suffix = backup[len(backup_filename(shotwell_db, "")) :]
+        if suffix.isdigit():
+            backups[int(suffix)] = backup
+    kept = sorted(i for i in backups if i in import_ids)[-keep:] if keep else []
+    for import_id, backup in sorted(backups.items()):
+        if import_id not in kept:
+            os.remove(backup)
+            _log.info("Removed the backup of import %s, %s", import_id, backup)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Undo an import from iPhoto to Shotwell. Shotwell must not "
+        "be running. The imported files are left in place."
+    )
+    parser.add_argument(
+        "import_id",
+        metavar="IMPORT_ID",
+        type=int,
+        nargs="?",
+        help="id of the import to undo, see --list",
+    )
+    parser.add_argument(
+        "--shotwell-db",
+        dest="shotwell_db",
+        default=os.path.expanduser("~/.local/share/shotwell/data/photo.db"),
+        help="location of the shotwell photo.db file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--list",
+        dest="list",
+        action="store_true",
+        help="list the imports and their backups",
+    )
+    parser.add_argument(
+        "--restore-backup",
+        dest="restore_backup",
+        action="store_true",
+        help="restore the backup taken when the import started instead of "
+        "deleting the imported rows, this also undoes any later change",
+    )
+
+    parser.add_argument(
+        "--prune",
+        dest="prune",
+        type=int,
+        nargs="?",
+        const=1,
+        default=None,
+        metavar="KEEP",
+        help="remove the backups of all but the KEEP (default: 1) most recent "
+        "imports, and of the imports rolled back",
+    )
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.list:
+        list_imports(args.shotwell_db)
+    elif args.prune is not None:
+        if args.prune < 0:
+            parser.error("--prune KEEP can't be negative")
+        prune_backups(args.shotwell_db, args.prune)
+    elif args.import_id is None:
+        parser.error("IMPORT_ID is required")
+    elif args.restore_backup:
+        restore_backup(args.shotwell_db, args.import_id)
+    else:
+        undo_import(args.shotwell_db, args.import_id)
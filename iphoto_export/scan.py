@@ -0,0 +1,113 @@
+import collections
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+_log = logging.getLogger("iphotoimport")
+
+# Directories of an iPhoto library holding the images, see StatIndex.
+LIBRARY_IMAGE_DIRS = ("Masters", "Modified", "Originals")
+
+# Number of directories listed at the same time.  Listing is bound by the
+# latency of the (possibly network) file system rather than by the CPU.
+DEFAULT_SCAN_JOBS = 16
+
+# The parts of os.stat_result the importer uses.
+FileStat = collections.namedtuple(
+    "FileStat",
+    ("st_size", "st_mtime", "st_mtime_ns", "st_ino", "st_dev", "st_nlink"),
+)
+
+
+def file_stat(st):
+    return FileStat(
+        st.st_size, st.st_mtime, st.st_mtime_ns, st.st_ino, st.st_dev, st.st_nlink
+    )
+
+
+class StatIndex:
+    """Names of the files below some directories, to stat them on demand.
+
+    The trees are listed once with os.scandir(), several directories at a
+    time.  Files are told from directories by the type the listing returns,
+    so a missing file is known to be missing without a syscall, and only
+    the files actually looked up are stat'ed.  Paths outside of the trees
+    are stat'ed as usual.
+    """
+
+    def __init__(self, roots=()):
+        self.roots = roots
+        self.dirs = {}  # dir -> set of the names of its files
+        self.files = 0
+
+    @classmethod
+    def for_library(cls, iphoto_dir, jobs=DEFAULT_SCAN_JOBS, selection=None):
+        # A partial import only lists the directories its --path-prefix
+        # selects, and none if it selects by roll or date: listing the whole
+        # library would cost more than stat'ing the files it takes.
+        if not selection:
+            names = LIBRARY_IMAGE_DIRS
+        elif (
+            selection.rolls is None
+            and selection.since is None
+            and selection.until is None
+        ):
+            names = selection.path_prefixes
+        else:
+            names = ()
+        roots = [os.path.join(iphoto_dir, name) for name in names]
+        index = cls([root for root in roots if os.path.isdir(root)])
+        index.scan(jobs)
+        return index
+
+    def scan(self, jobs=DEFAULT_SCAN_JOBS):
+        seen = {(st.st_dev, st.st_ino) for st in map(os.stat, self.roots)}
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            pending = {executor.submit(self._scan_dir, root) for root in self.roots}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, files, subdirs = future.result()
+                    if files is None:
+                        continue
+                    self.dirs[path] = files
+                    self.files += len(files)
+                    for subdir, st in subdirs:
+                        # Directory symlinks may loop.
+                        if (st.st_dev, st.st_ino) not in seen:
+                            seen.add((st.st_dev, st.st_ino))
+                            pending.add(executor.submit(self._scan_dir, subdir))
+        _log.debug("Indexed %s files in %s directories", self.files, len(self.dirs))
+
+    def _scan_dir(self, path):
+        # Returns the names of the files of path and the (path, stat) of its
+        # sub directories, files is None if path can't be listed.
+        files = set()
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            subdirs.append((entry.path, entry.stat()))
+                        elif entry.is_file():
+                            files.add(entry.name)
+                    except OSError:
+                        # A broken symlink or the file went away.
+                        continue
+        except OSError as e:
+            _log.warning("Failed to list %s: %s", path, e)
+            return path, None, subdirs
+        return path, files, subdirs
+
+    def stat(self, path):
+        # Returns the FileStat of path, None if it doesn't exist.  Files that
+        # aren't in the listed directories aren't stat'ed.
+        dirname, name = os.path.split(path)
+        files = self.dirs.get(dirname)
+        if files is not None and name not in files:
+            return None
+        try:
+            return file_stat(os.stat(path))
+        except OSError:
+            return None
@@ -0,0 +1,102 @@
+import hashlib
+import logging
+import os
+import time
+
+from iphoto_export.database import SyncTable
+
+_log = logging.getLogger("iphotoimport")
+
+# Kinds of change of a Master Image List entry since the last sync.
+NEW = "new"
+CHANGED = "changed"
+
+# Seconds between two checks of AlbumData.xml in watch mode.
+DEFAULT_WATCH_INTERVAL = 60
+
+
+def entry_digest(i_photo):
+    # ImagePath and OriginalPath as a signed 64 bit int, what sqlite stores.
+    paths = "%s\0%s" % (i_photo.get("ImagePath"), i_photo.get("OriginalPath"))
+    return int.from_bytes(
+        hashlib.md5(paths.encode("utf-8")).digest()[:8], "big", signed=True
+    )
+
+
+class SyncState:
+    """What the last sync of a library saw of its Master Image List.
+
+    Entries are remembered by key with a digest of their ImagePath and
+    OriginalPath, which iPhoto changes when a photo is edited or reverted.
+    The entries a sync finds unchanged are dropped before any of their
+    files is touched.  The state is kept in memory between syncs and in the
+    IPhotoSyncTable of the Shotwell DB across runs.
+    """
+
+    def __init__(self, iphoto_dir):
+        self.iphoto_dir = iphoto_dir
+        self.digests = None  # key -> digest, loaded by begin()
+        self.pending = {}  # Digests of the entries seen by the current sync.
+
+    def begin(self, db):
+        if self.digests is None:
+            self.digests = SyncTable(db).digests(self.iphoto_dir)
+            _log.debug("Loaded the sync state of %s entries", len(self.digests))
+        self.pending = {}
+
+    @property
+    def warm(self):
+        # True once a sync has recorded the library.
+        return bool(self.digests)
+
+    def change(self, key, i_photo):
+        # Returns NEW or CHANGED, or None if the entry is as it was last
+        # synced.
+        key = int(key)
+        digest = entry_digest(i_photo)
+        last = self.digests.get(key)
+        if last == digest:
+            return None
+        self.pending[key] = digest
+        return NEW if last is None else CHANGED
+
+    def retry(self, key):
+        # The entry is looked at again by the next sync, e.g. its file is
+        # missing for now.
+        self.pending.pop(int(key), None)
+
+    def save(self, db):
+        # Called in the transaction finishing the sync.
+        SyncTable(db).save(self.iphoto_dir, self.pending.items())
+        self.digests.update(self.pending)
+        self.pending = {}
+
+
+def watch(filename, sync, interval=DEFAULT_WATCH_INTERVAL):
+    """Call sync() now and whenever filename changes, until interrupted.
+
+    filename is polled with os.stat() every interval seconds.  A change is
+    only synced once the file has stayed the same for one interval, so a
+    file still being written isn't read.  A failed sync is retried at the
+    next poll.
+    """
+    last_synced = None
+    seen = _signature(filename)
+    while True:
+        signature = _signature(filename)
+        if signature is not None and signature == seen and signature != last_synced:
+            try:
+                sync()
+                last_synced = signature
+            except Exception:
+                _log.exception("Sync failed, retrying in %s seconds", interval)
+        seen = signature
+        time.sleep(interval)
+
+
+def _signature(filename):
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
@@ -0,0 +1,74 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image  # @UnresolvedImport
+
+_log = logging.getLogger("iphotoimport")
+
+# Where Shotwell looks for its thumbnails, one sub directory per size.
+DEFAULT_THUMBNAIL_DIR = "~/.cache/shotwell/thumbs"
+THUMBNAIL_SIZES = (360, 128)
+# Shotwell's Jpeg.Quality.HIGH
+THUMBNAIL_QUALITY = 90
+
+# PIL transposition turning an image with the given EXIF orientation upright.
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def thumbnail_filename(thumbnail_dir, size, photo_id):
+    # Shotwell names thumbnails after the PhotoTable id, see PhotoID.
+    return os.path.join(thumbnail_dir, "thumbs%d" % size, "thumb%016x.jpg" % photo_id)
+
+
+class ThumbnailWriter:
+    """Writes Shotwell's thumbnails for a photo.
+
+    A task is a tuple of (photo_id, path, orientation).  JPEGs are decoded
+    in draft mode, i.e. downscaled by the decoder, so only a fraction of
+    the full size image is ever decompressed.
+    """
+
+    def __init__(self, thumbnail_dir):
+        self.thumbnail_dir = thumbnail_dir
+
+    def __call__(self, task):
+        photo_id, path, orientation = task
+        try:
+            img = Image.open(path)
+            largest = THUMBNAIL_SIZES[0]
+            img.draft("RGB", (largest, largest))
+            img = img.convert("RGB")
+            if orientation in ORIENTATION_TRANSPOSE:
+                img = img.transpose(ORIENTATION_TRANSPOSE[orientation])
+            for size in THUMBNAIL_SIZES:
+                img.thumbnail((size, size), Image.Resampling.LANCZOS)
+                filename = thumbnail_filename(self.thumbnail_dir, size, photo_id)
+                img.save(filename, "JPEG", quality=THUMBNAIL_QUALITY)
+        except Exception:
+            _log.exception("Failed to generate the thumbnails of %s", path)
+            return False
+        return True
+
+
+def write_thumbnails(tasks, thumbnail_dir, jobs=1):
+    thumbnail_dir = os.path.expanduser(thumbnail_dir)
+    for size in THUMBNAIL_SIZES:
+        os.makedirs(os.path.join(thumbnail_dir, "thumbs%d" % size), exist_ok=True)
+    writer = ThumbnailWriter(thumbnail_dir)
+    _log.debug("Generating thumbnails in %s", thumbnail_dir)
+    if jobs <= 1:
+        written = sum(writer(task) for task in tasks)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            written = sum(executor.map(writer, tasks, chunksize=16))
+    _log.info("Generated thumbnails of %s photos", written)
+    return written
@@ -0,0 +1,263 @@
+import argparse
+import collections
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from iphoto_export.cache import ProbeCache
+from iphoto_export.database import ImportTable
+from iphoto_export.fs import FileSystem
+from iphoto_export.metrics import Progress
+from iphoto_export.pipeline import map_bounded
+
+_log = logging.getLogger("iphotoimport")
+
+# Problems found with a file.
+MISSING = "missing"
+SIZE = "size"
+MTIME = "mtime"
+MD5 = "md5"
+# The problems meaning the file doesn't hold the bytes that were imported.  A
+# changed mtime alone doesn't, copied files get the time of the copy.
+CONTENT_PROBLEMS = (MISSING, SIZE, MD5)
+
+# A row of the Shotwell DB pointing at an imported file.  md5 is None for
+# BackingPhotoTable rows, Shotwell doesn't record it.
+Entry = collections.namedtuple(
+    "Entry", ("table", "id", "path", "size", "timestamp", "md5")
+)
+
+
+def import_entries(db, import_ids):
+    """Yield the Entry of each file of the imports.
+
+    The PhotoTable and VideoTable rows with the import_ids, and the
+    BackingPhotoTable rows of those photos.
+    """
+    cursor = db.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type='table' AND name='VideoTable'"
+    )
+    has_videos = cursor.fetchone()[0]
+    for import_id in import_ids:
+        cursor = db.execute(
+            "SELECT id, filename, filesize, timestamp, md5 FROM PhotoTable "
+            "WHERE import_id = ? ORDER BY id",
+            (import_id,),
+        )
+        for row in cursor:
+            yield Entry("PhotoTable", *row)
+        cursor = db.execute(
+            "SELECT DISTINCT b.id, b.filepath, b.filesize, b.timestamp, NULL "
+            "FROM BackingPhotoTable b JOIN PhotoTable p ON p.editable_id = b.id "
+            "WHERE p.import_id = ? ORDER BY b.id",
+            (import_id,),
+        )
+        for row in cursor:
+            yield Entry("BackingPhotoTable", *row)
+        if has_videos:
+            cursor = db.execute(
+                "SELECT id, filename, filesize, timestamp, md5 FROM VideoTable "
+                "WHERE import_id = ? ORDER BY id",
+                (import_id,),
+            )
+            for row in cursor:
+                yield Entry("VideoTable", *row)
+
+
+class FileVerifier:
+    """Checks an imported file against its Entry.
+
+    Called from a pool of threads, hashlib releases the GIL while hashing.
+    The result is a tuple of (entry, problems) where problems lists a dict
+    per mismatch.  The md5 comes from the probe cache if the file is a hard
+    link to a source the importer probed and neither has changed since,
+    copied files are hashed.  The cache is only read, it holds the probes of
+    the importer.
+    """
+
+    def __init__(self, fs, cache_filename=None):
+        self.fs = fs
+        self.cache_filename = cache_filename
+        self._local = threading.local()
+
+    @property
+    def cache(self):
+        # Each thread reads the cache through its own connection, see
+        # PhotoProber.cache.
+        if not self.cache_filename:
+            return None
+        cache = getattr(self._local, "cache", None)
+        if cache is None:
+            cache = self._local.cache = ProbeCache(self.cache_filename, readonly=True)
+        return cache
+
+    def __call__(self, entry):
+        problems = []
+        try:
+            st = os.stat(entry.path)
+        except OSError:
+            problems.append(_problem(MISSING, True, False))
+            return entry, problems
+        if entry.size is not None and st.st_size != entry.size:
+            problems.append(_problem(SIZE, entry.size, st.st_size))
+        if entry.timestamp is not None and int(st.st_mtime) != entry.timestamp:
+            problems.append(_problem(MTIME, entry.timestamp, int(st.st_mtime)))
+        # Files of another size can't have the same md5.
+        if entry.md5 is not None and not any(p["problem"] == SIZE for p in problems):
+            info = self.cache.get_by_inode(st) if self.cache else None
+            if info is None:
+                md5 = self.fs.md5_for_file(entry.path)
+            else:
+                md5 = info["md5"]
+            if md5 != entry.md5:
+                problems.append(_problem(MD5, entry.md5, md5))
+        return entry, problems
+
+
+def _problem(problem, expected, actual):
+    return {"problem": problem, "expected": expected, "actual": actual}
+
+
+def verify_files(verifier, entries, jobs=1):
+    # Runs verifier over entries on a pool of threads, yielding the results
+    # in order with a bounded number of files in flight.
+    if jobs <= 1:
+        for entry in entries:
+            yield verifier(entry)
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        yield from map_bounded(executor, verifier, entries, jobs)
+
+
+def verify_import(shotwell_db, import_ids=None, sample=1.0, jobs=1, probe_cache=None):
+    """Check the files of imports against the Shotwell DB.
+
+    Every file, or a random sample fraction of them, is checked for
+    existence, size, mtime and md5.  import_ids defaults to all imports done
+    by iphoto_import.  Returns the report as a dict, with a "mismatches" list
+    of the files with problems.
+    """
+    db = sqlite3.connect(shotwell_db)
+    if import_ids is None:
+        import_ids = [row[0] for row in ImportTable(db).imports()]
+    _log.info("Verifying imports %s", ", ".join(map(str, import_ids)))
+    entries = list(import_entries(db, import_ids))
+    db.close()
+    total = len(entries)
+    if sample < 1.0:
+        entries = [entry for entry in entries if random.random() < sample]
+
+    if probe_cache and not os.path.exists(probe_cache):
+        probe_cache = None
+    verifier = FileVerifier(FileSystem(False), probe_cache)
+    mismatches = []
+    counts = collections.Counter()
+    progress = Progress(lambda: progress.done / (len(entries) or 1))
+    for entry, problems in verify_files(verifier, entries, jobs):
+        progress.update()
+        for problem in problems:
+            counts[problem["problem"]] += 1
+            mismatches.append(
+                dict(table=entry.table, id=entry.id, path=entry.path, **problem)
+            )
+    progress.finish()
+
+    failed = {
+        (m["table"], m["id"]) for m in mismatches if m["problem"] in CONTENT_PROBLEMS
+    }
+    _log.info(
+        "Checked %s of %s files, %s don't match what was imported",
+        len(entries),
+        total,
+        len(failed),
+    )
+    for problem, count in sorted(counts.items()):
+        _log.info("%s mismatch: %s", problem, count)
+    return {
+        "shotwell_db": shotwell_db,
+        "import_ids": import_ids,
+        "files": total,
+        "checked": len(entries),
+        "failed": len(failed),
+        "problems": dict(counts),
+        "mismatches": mismatches,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the files imported from iPhoto against the Shotwell DB."
+    )
+    parser.add_argument(
+        "--shotwell-db",
+        dest="shotwell_db",
+        default=os.path.expanduser("~/.local/share/shotwell/data/photo.db"),
+        help="location of the shotwell photo.db file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--import-id",
+        dest="import_ids",
+        type=int,
+        action="append",
+        default=None,
+        help="import to check, may be repeated, defaults to all the imports "
+        "listed by python -m iphoto_export.rollback --list",
+    )
+    parser.add_argument(
+        "--sample",
+        dest="sample",
+        type=float,
+        default=1.0,
+        help="fraction of the files to check, e.g. 0.01 for a quick spot check",
+    )
+    parser.add_argument(
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of files checked in parallel, defaults to the number of CPUs",
+    )
+    parser.add_argument(
+        "--probe-cache",
+        dest="probe_cache",
+        default=None,
+        help="probe cache of the importer whose md5s are trusted for hard links "
+        "to sources that haven't changed since they were probed, defaults to "
+        "the Shotwell DB path with a .probecache suffix",
+    )
+    parser.add_argument(
+        "--no-probe-cache",
+        dest="use_probe_cache",
+        action="store_false",
+        help="hash every file",
+    )
+    parser.add_argument(
+        "--report",
+        dest="report",
+        default="-",
+        help="file the JSON report is written to (default: standard output)",
+    )
+
+    args = parser.parse_args()
+    if not 0 < args.sample <= 1:
+        parser.error("--sample must be in (0, 1]")
+    probe_cache = None
+    if args.use_probe_cache:
+        probe_cache = args.probe_cache or "%s.probecache" % args.shotwell_db
+
+    logging.basicConfig(level=logging.INFO)
+    report = verify_import(
+        args.shotwell_db, args.import_ids, args.sample, args.jobs, probe_cache
+    )
+    if args.report == "-":
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+    sys.exit(1 if report["failed"] else 0)
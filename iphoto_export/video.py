@@ -0,0 +1,110 @@
+import os
+import struct
+
+# Mime types of the movies read_video_header() parses.
+VIDEO_MIMES = ("video/quicktime", "video/mp4", "video/x-m4v")
+
+# Seconds from the QuickTime epoch, 1904-01-01 UTC, to the Unix epoch.
+QUICKTIME_EPOCH_OFFSET = 2082844800
+
+# Bytes read from the start of mvhd and tkhd, enough for their version 1
+# layouts up to the track's width and height.
+MVHD_SIZE = 32
+TKHD_SIZE = 96
+
+
+class AtomError(Exception):
+    pass
+
+
+def read_video_header(path):
+    """Read the size, duration and creation time of an MP4/QuickTime movie.
+
+    Only the headers of the atoms on the way to moov/mvhd and moov/trak/tkhd
+    are read, everything else is seeked over, so probing a movie reads a few
+    KB whatever its size.  Returns a dict with width, height, duration (in
+    seconds) and creation_time (a Unix timestamp or None if it isn't set) or
+    None if the file isn't a movie that can be parsed.
+    """
+    header = {"width": None, "height": None, "duration": None, "creation_time": None}
+    # Unbuffered, so each seek reads only the few bytes asked for.
+    with open(path, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        try:
+            for kind, start, end in _atoms(f, 0, size):
+                if kind == b"moov":
+                    _moov(f, start, end, header)
+                    break
+            else:
+                raise AtomError("no moov atom")
+        except (AtomError, struct.error):
+            return None
+    if header["duration"] is None:
+        return None
+    return header
+
+
+def _atoms(f, start, end):
+    # Yields the type, payload start and end of the atoms between start and
+    # end.
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        data = f.read(16)
+        size, kind = struct.unpack_from(">I4s", data)
+        payload = pos + 8
+        if size == 1:
+            # 64 bit size following the type.
+            (size,) = struct.unpack_from(">Q", data, 8)
+            payload = pos + 16
+        elif size == 0:
+            # The atom runs to the end of its parent.
+            size = end - pos
+        if not kind.isalnum() and kind not in (b"free", b"skip", b"wide"):
+            raise AtomError("not an atom at %d" % pos)
+        if size < payload - pos or pos + size > end:
+            raise AtomError("bad size of the %r atom at %d" % (kind, pos))
+        yield kind, payload, pos + size
+        pos += size
+
+
+def _read(f, start, end, size):
+    f.seek(start)
+    return f.read(min(size, end - start))
+
+
+def _moov(f, start, end, header):
+    for kind, child_start, child_end in _atoms(f, start, end):
+        if kind == b"mvhd":
+            _mvhd(_read(f, child_start, child_end, MVHD_SIZE), header)
+        elif kind == b"trak" and header["width"] is None:
+            for track_kind, track_start, track_end in _atoms(f, child_start, child_end):
+                if track_kind == b"tkhd":
+                    _tkhd(_read(f, track_start, track_end, TKHD_SIZE), header)
+                    break
+
+
+def _mvhd(data, header):
+    if not data:
+        raise AtomError("empty mvhd")
+    if data[0] == 1:
+        created, _, timescale, duration = struct.unpack_from(">QQIQ", data, 4)
+    else:
+        created, _, timescale, duration = struct.unpack_from(">IIII", data, 4)
+    if timescale == 0:
+        raise AtomError("mvhd without a timescale")
+    header["duration"] = duration / timescale
+    if created > QUICKTIME_EPOCH_OFFSET:
+        header["creation_time"] = created - QUICKTIME_EPOCH_OFFSET
+
+
+def _tkhd(data, header):
+    # Audio tracks have no size, the first track with one is the video.
+    if not data:
+        raise AtomError("empty tkhd")
+    offset = 88 if data[0] == 1 else 76
+    width, height = struct.unpack_from(">II", data, offset)
+    if width and height:
+        # 16.16 fixed point.
+        header["width"] = width >> 16
+        header["height"] = height >> 16
@@ -0,0 +1,108 @@
+import errno
+import hashlib
+import os
+
+import pytest
+
+from iphoto_export.fs import Copy, CopyEngine, FileSystem
+
+DATA = b"\xff\xd8" + b"x" * 4000
+
+
+@pytest.fixture
+def cross_device(tmp_path, monkeypatch):
+    # The library is on another file system than the destination: hard links
+    # from the library fail, hard links within the destination work.
+    library = tmp_path / "library"
+    library.mkdir()
+    link = os.link
+
+    def cross_device_link(src, dst):
+        if str(src).startswith(str(library)):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        link(src, dst)
+
+    monkeypatch.setattr(os, "link", cross_device_link)
+    fs = FileSystem(False)
+    monkeypatch.setattr(fs, "dir_dev", lambda dir: -1)
+    return library, tmp_path / "photos", fs
+
+
+@pytest.mark.parametrize("copied", [False, True])
+def test_modified_version_linked_to_the_original_copy(cross_device, copied):
+    # The modified version has the size of the original, so the prober only
+    # hashed it, and is the same bytes.  The original was either copied
+    # while it was hashed or came from the probe cache.
+    library, photos, fs = cross_device
+    md5 = hashlib.md5(DATA).hexdigest()
+    for name in ("orig.jpg", "mod.jpg"):
+        (library / name).write_bytes(DATA)
+    orig = photos / "Originals" / "orig.jpg"
+    mod = photos / "Modified" / "mod.jpg"
+    if copied:
+        fs.read_file(str(library / "orig.jpg"), str(orig))
+    engine = CopyEngine(fs, jobs=1)
+    engine.copy(
+        [
+            Copy(str(library / "orig.jpg"), str(orig), md5, len(DATA), copied),
+            Copy(str(library / "mod.jpg"), str(mod), md5, len(DATA)),
+        ]
+    )
+    assert os.path.samefile(orig, mod)
+    assert mod.read_bytes() == DATA
+    assert engine.bytes == len(DATA)
+    assert engine.saved == len(DATA)
+
+
+def test_different_bytes_are_copied(cross_device):
+    library, photos, fs = cross_device
+    (library / "a.jpg").write_bytes(DATA)
+    (library / "b.jpg").write_bytes(DATA[::-1])
+    engine = CopyEngine(fs, jobs=1)
+    engine.copy(
+        [
+            Copy(str(library / name), str(photos / name), md5, len(DATA))
+            for name, md5 in (
+                ("a.jpg", hashlib.md5(DATA).hexdigest()),
+                ("b.jpg", hashlib.md5(DATA[::-1]).hexdigest()),
+            )
+        ]
+    )
+    assert (photos / "b.jpg").read_bytes() == DATA[::-1]
+    assert not os.path.samefile(photos / "a.jpg", photos / "b.jpg")
+    assert engine.bytes == 2 * len(DATA)
+    assert engine.saved == 0
+
+
+def test_hard_links_to_the_library_are_not_deduplicated(tmp_path):
+    library = tmp_path / "library"
+    library.mkdir()
+    for name in ("a.jpg", "b.jpg"):
+        (library / name).write_bytes(DATA)
+    md5 = hashlib.md5(DATA).hexdigest()
+    engine = CopyEngine(FileSystem(False), jobs=1)
+    engine.copy(
+        [
+            Copy(str(library / name), str(tmp_path / "photos" / name), md5, len(DATA))
+            for name in ("a.jpg", "b.jpg")
+        ]
+    )
+    for name in ("a.jpg", "b.jpg"):
+        assert os.path.samefile(library / name, tmp_path / "photos" / name)
+    assert engine.bytes == 0
+    assert engine.saved == 0
+
+
+@pytest.mark.parametrize("hashed", [False, True])
+def test_copies_keep_the_mtime(tmp_path, hashed):
+    src = tmp_path / "src.jpg"
+    src.write_bytes(DATA)
+    os.utime(src, ns=(1300000000123456789, 1300000000123456789))
+    dst = tmp_path / "photos" / "src.jpg"
+    fs = FileSystem(True)
+    if hashed:
+        fs.read_file(str(src), str(dst))
+    else:
+        fs.safe_link_file(str(src), str(dst))
+    assert dst.read_bytes() == DATA
+    assert dst.stat().st_mtime_ns == src.stat().st_mtime_ns
@@ -0,0 +1,128 @@
+import datetime
+import io
+import mimetypes
+
+import pytest
+from PIL import Image
+
+from iphoto_export.header import read_header
+from iphoto_export.probe import FILE_FORMAT
+
+DATETIME = "2010:07:14 12:34:56"
+
+
+def exif(orientation=6, date=DATETIME):
+    tags = Image.Exif()
+    tags[0x0112] = orientation
+    tags[0x0132] = date
+    return tags
+
+
+def image_bytes(format, size=(64, 48), **kwargs):
+    out = io.BytesIO()
+    Image.new("RGB", size, "red").save(out, format, **kwargs)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize(
+    "format, mime",
+    [("JPEG", "image/jpeg"), ("PNG", "image/png"), ("TIFF", "image/tiff")],
+)
+def test_size_orientation_and_date(format, mime):
+    head = image_bytes(format, exif=exif())
+    assert read_header(head, mime) == {
+        "width": 64,
+        "height": 48,
+        "orientation": 6,
+        "datetime": datetime.datetime(2010, 7, 14, 12, 34, 56),
+    }
+
+
+@pytest.mark.parametrize(
+    "format, mime",
+    [("JPEG", "image/jpeg"), ("PNG", "image/png"), ("TIFF", "image/tiff")],
+)
+def test_without_exif(format, mime):
+    head = image_bytes(format, size=(3, 5))
+    assert read_header(head, mime) == {
+        "width": 3,
+        "height": 5,
+        "orientation": 1,
+        "datetime": None,
+    }
+
+
+def test_big_endian_tiff():
+    # PIL writes little endian TIFFs, build a minimal big endian IFD0.
+    entries = [
+        (0x0100, 3, 1, (640 << 16).to_bytes(4, "big")),
+        (0x0101, 4, 1, (480).to_bytes(4, "big")),
+        (0x0112, 3, 1, (3 << 16).to_bytes(4, "big")),
+    ]
+    head = b"MM\x00*" + (8).to_bytes(4, "big") + len(entries).to_bytes(2, "big")
+    for tag, field_type, n, value in entries:
+        head += (
+            tag.to_bytes(2, "big")
+            + field_type.to_bytes(2, "big")
+            + n.to_bytes(4, "big")
+            + value
+        )
+    head += b"\x00" * 4
+    header = read_header(head, "image/tiff")
+    assert (header["width"], header["height"], header["orientation"]) == (
+        640,
+        480,
+        3,
+    )
+
+
+def test_invalid_date_is_left_to_the_caller():
+    head = image_bytes("JPEG", exif=exif(date="2007:00:00 00:00:00"))
+    assert read_header(head, "image/jpeg")["datetime"] == "2007:00:00 00:00:00"
+
+
+def test_jpeg_with_exif_after_the_first_block():
+    # The SOF isn't in head, the caller has to decode the file.
+    head = image_bytes("JPEG", exif=exif())
+    sof = head.index(b"\xff\xc0")
+    assert read_header(head[:sof], "image/jpeg") is None
+
+
+def test_png_exif_in_a_text_chunk_is_not_parsed():
+    head = image_bytes("PNG")
+    iend = head.index(b"IDAT") - 4
+    text = b"Raw profile type exif\x00\nexif\n0\n"
+    chunk = len(text).to_bytes(4, "big") + b"tEXt" + text + b"\x00" * 4
+    assert read_header(head[:iend] + chunk + head[iend:], "image/png") is None
+
+
+@pytest.mark.parametrize("mime", ["image/bmp", "image/x-ms-bmp"])
+def test_bmp(mime):
+    head = image_bytes("BMP", size=(17, 9))
+    assert read_header(head, mime) == {
+        "width": 17,
+        "height": 9,
+        "orientation": 1,
+        "datetime": None,
+    }
+
+
+def test_top_down_bmp():
+    head = bytearray(image_bytes("BMP", size=(17, 9)))
+    head[22:26] = (-9).to_bytes(4, "little", signed=True)
+    assert read_header(bytes(head), "image/bmp")["height"] == 9
+
+
+def test_bmp_mime_is_imported():
+    mime, _ = mimetypes.guess_type("photo.bmp")
+    assert mime in FILE_FORMAT
+    assert read_header(image_bytes("BMP"), mime) is not None
+
+
+@pytest.mark.parametrize("mime", ["image/jpeg", "image/png", "image/tiff", "image/bmp"])
+def test_not_an_image(mime):
+    assert read_header(b"\x00" * 64, mime) is None
+
+
+def test_unknown_mime():
+    assert read_header(image_bytes("JPEG"), "image/gif") is None
@@ -0,0 +1,98 @@
+import struct
+
+import pytest
+
+from iphoto_export.video import QUICKTIME_EPOCH_OFFSET, read_video_header
+
+CREATED = 1300000000
+
+
+def atom(kind, payload):
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def mvhd(version, created, timescale, duration):
+    if version == 1:
+        body = struct.pack(">B3xQQIQ", 1, created, created, timescale, duration)
+    else:
+        body = struct.pack(">B3xIIII", 0, created, created, timescale, duration)
+    # Rate, volume, matrix and the rest of the atom.
+    return atom(b"mvhd", body + b"\x00" * 80)
+
+
+def tkhd(version, width, height):
+    if version == 1:
+        # Created, modified, track id, reserved and duration.
+        body = struct.pack(">B3xQQIIQ", 1, 0, 0, 1, 0, 0)
+    else:
+        body = struct.pack(">B3xIIIII", 0, 0, 0, 1, 0, 0)
+    # Reserved, layer, alternate group, volume, reserved and the matrix.
+    body += b"\x00" * 16 + b"\x00" * 36
+    return atom(b"tkhd", body + struct.pack(">II", width << 16, height << 16))
+
+
+def movie(version=0, created=CREATED + QUICKTIME_EPOCH_OFFSET, moov_first=True):
+    moov = atom(
+        b"moov",
+        mvhd(version, created, 600, 7500)
+        # An audio track without a size comes first.
+        + atom(b"trak", tkhd(version, 0, 0) + atom(b"mdia", b"\x00" * 20))
+        + atom(b"trak", tkhd(version, 1920, 1080) + atom(b"mdia", b"\x00" * 20)),
+    )
+    ftyp = atom(b"ftyp", b"qt  \x00\x00\x00\x00qt  ")
+    mdat = atom(b"mdat", b"\x00" * 4096)
+    return ftyp + (moov + mdat if moov_first else mdat + moov)
+
+
+def read(tmp_path, data):
+    path = tmp_path / "movie.mov"
+    path.write_bytes(data)
+    return read_video_header(str(path))
+
+
+@pytest.mark.parametrize("version", [0, 1])
+@pytest.mark.parametrize("moov_first", [True, False])
+def test_header(tmp_path, version, moov_first):
+    assert read(tmp_path, movie(version, moov_first=moov_first)) == {
+        "width": 1920,
+        "height": 1080,
+        "duration": 12.5,
+        "creation_time": CREATED,
+    }
+
+
+def test_unset_creation_time(tmp_path):
+    assert read(tmp_path, movie(created=0))["creation_time"] is None
+
+
+def test_64_bit_mdat(tmp_path):
+    data = b"\x00" * 4096
+    mdat = struct.pack(">I4sQ", 1, b"mdat", 16 + len(data)) + data
+    ftyp = atom(b"ftyp", b"isom\x00\x00\x00\x00isom")
+    header = read(tmp_path, ftyp + mdat + movie()[len(ftyp) :])
+    assert header["duration"] == 12.5
+
+
+def test_atom_running_to_the_end_of_the_file(tmp_path):
+    # The last atom may have a size of 0.
+    data = movie() + struct.pack(">I4s", 0, b"free") + b"\x00" * 100
+    assert read(tmp_path, data)["width"] == 1920
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"\x00\x00\x00\x05junkjunk",
+        atom(b"ftyp", b"qt  ") + atom(b"mdat", b"\x00" * 64),
+        # The size of moov runs past the end of the file.
+        struct.pack(">I4s", 1000, b"moov") + mvhd(0, 0, 600, 600),
+        # mvhd without a timescale.
+        atom(b"moov", mvhd(0, 0, 0, 600)),
+        # Truncated clips with empty headers.
+        atom(b"moov", atom(b"mvhd", b"")),
+        atom(b"moov", mvhd(0, 0, 600, 600) + atom(b"trak", atom(b"tkhd", b""))),
+    ],
+)
+def test_not_a_movie(tmp_path, data):
+    assert read(tmp_path, data) is None